@@ -0,0 +1,176 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from ImageLoader import ImageLoader
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+EVENT_BUFFER_SIZE = 64 * 1024
+
+# quiet time after the writer closed the file (inotify), and stable time for files whose
+# writer may still have them open (found by a scan or the polling fallback)
+SETTLE_SECONDS = 0.2
+UNCLOSED_SETTLE_SECONDS = 3.0
+POLL_SECONDS = 1.0
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths_by_wd: Dict[int, Path] = {}
+
+    def add_watch(self, path: Path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.paths_by_wd[wd] = path
+
+    def read(self, timeout: float) -> List[Tuple[Path, int, str]]:
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_IGNORED:
+                self.paths_by_wd.pop(wd, None)
+            elif wd in self.paths_by_wd or mask & IN_Q_OVERFLOW:
+                events.append((self.paths_by_wd.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Reports loadable files in the watched directories once they stopped changing
+class DirectoryWatcher:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, dirs: List[Path], use_inotify: bool = True):
+        self.dirs = dirs
+        self.inotify = None
+        # path -> (size, mtime_ns, time of the last change, closed by the writer)
+        self.candidates: Dict[Path, Tuple[int, int, float, bool]] = {}
+        # files that were reported but are still there (failed to load), only reported again once they change
+        self.left: Dict[Path, Tuple[int, int]] = {}
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                self.logger.warning(f"inotify is not available, polling every {POLL_SECONDS}s instead: {e}")
+        for path in dirs:
+            self.scan(path)
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+    def scan(self, dir_path: Path):
+        if self.inotify:
+            try:
+                self.inotify.add_watch(dir_path)
+            except OSError as e:
+                self.logger.warning(f"Failed to watch {dir_path}: {e}")
+        try:
+            entries = list(os.scandir(dir_path))
+        except OSError as e:
+            self.logger.warning(f"Failed to scan {dir_path}: {e}")
+            return
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if self.inotify:
+                    self.scan(Path(entry.path))
+            elif ImageLoader.loadable_re.match(entry.name):
+                self.changed(Path(entry.path), False)
+
+    def changed(self, path: Path, closed: bool):
+        try:
+            stat = path.stat()
+        except OSError:
+            self.candidates.pop(path, None)
+            return
+        if not closed and self.left.get(path) == (stat.st_size, stat.st_mtime_ns):
+            return
+        previous = self.candidates.get(path)
+        if previous and previous[:2] == (stat.st_size, stat.st_mtime_ns) and not closed:
+            return
+        self.candidates[path] = (stat.st_size, stat.st_mtime_ns, time.monotonic(), closed or bool(previous and previous[3]))
+
+    def poll(self):
+        for dir_path in self.dirs:
+            for root, dir_names, file_names in os.walk(dir_path):
+                dir_names[:] = [name for name in dir_names if not name.startswith(".")]
+                for name in file_names:
+                    if ImageLoader.loadable_re.match(name):
+                        self.changed(Path(os.path.join(root, name)), False)
+
+    def wait_ready(self, timeout: float) -> List[Path]:
+        if self.inotify:
+            for dir_path, mask, name in self.inotify.read(min(timeout, SETTLE_SECONDS) if self.candidates else timeout):
+                if mask & IN_Q_OVERFLOW:
+                    self.logger.warning("inotify queue overflow, rescanning")
+                    for path in self.dirs:
+                        self.scan(path)
+                elif name.startswith("."):
+                    continue
+                elif mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.scan(Path(os.path.join(dir_path, name)))
+                elif ImageLoader.loadable_re.match(name):
+                    self.changed(Path(os.path.join(dir_path, name)), bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+        else:
+            time.sleep(min(timeout, POLL_SECONDS))
+            self.poll()
+        return self.take_ready()
+
+    def done(self, paths: List[Path]):
+        for path in paths:
+            self.left.pop(path, None)
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            self.left[path] = (stat.st_size, stat.st_mtime_ns)
+
+    def take_ready(self) -> List[Path]:
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime_ns, changed_at, closed) in list(self.candidates.items()):
+            if now - changed_at < (SETTLE_SECONDS if closed else UNCLOSED_SETTLE_SECONDS):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                del self.candidates[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.candidates[path] = (stat.st_size, stat.st_mtime_ns, now, closed)
+                continue
+            del self.candidates[path]
+            ready.append(path)
+        return sorted(ready)
@@ -0,0 +1,48 @@
+import logging
+import threading
+from contextlib import contextmanager
+from queue import Queue
+from typing import List
+
+import exiftool
+
+
+class ExifToolPool:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, size: int = 1):
+        self.size = max(1, size)
+        self.idle = Queue()
+        self.started: List[exiftool.ExifTool] = []
+        self.lock = threading.Lock()
+
+    def _start_one(self) -> exiftool.ExifTool:
+        exif_tool = exiftool.ExifTool()
+        exif_tool.start()
+        self.started.append(exif_tool)
+        self.logger.info(f"ExifTool started ({len(self.started)}/{self.size})")
+        return exif_tool
+
+    @contextmanager
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and len(self.started) < self.size:
+                self.idle.put(self._start_one())
+        exif_tool = self.idle.get()
+        try:
+            yield exif_tool
+        finally:
+            self.idle.put(exif_tool)
+
+    def terminate(self):
+        with self.lock:
+            while not self.idle.empty():
+                self.idle.get()
+            for exif_tool in self.started:
+                try:
+                    exif_tool.terminate()
+                except (OSError, ValueError) as e:
+                    self.logger.warning(f"Failed to terminate ExifTool: {e}")
+            if self.started:
+                self.logger.info(f"ExifTool terminated ({len(self.started)} processes)")
+            self.started = []
@@ -0,0 +1,174 @@
+import errno
+import logging
+import os
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Set
+
+from MoveJournal import MoveJournal
+from RunStats import stats
+
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class FileMover:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, threads: int = 4, journal: MoveJournal = None):
+        self.journal = journal
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.known_dirs: Set[str] = set()
+        self.taken_names: Dict[str, Set[str]] = {}
+        self.pending: Dict[str, Future] = {}
+
+    def ensure_dir(self, path: Path):
+        if str(path) not in self.known_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self.known_dirs.add(str(path))
+
+    def _names(self, dir_path: Path) -> Set[str]:
+        # Names are listed once per directory, then kept up to date by the operations below
+        names = self.taken_names.get(str(dir_path))
+        if names is None:
+            names = set(os.listdir(dir_path)) if dir_path.exists() else set()
+            self.taken_names[str(dir_path)] = names
+        return names
+
+    def is_taken(self, path: Path) -> bool:
+        return path.name in self._names(path.parent)
+
+    def _released(self, path: Path):
+        names = self.taken_names.get(str(path.parent))
+        if names is not None:
+            names.discard(path.name)
+
+    def wait(self, path: Path):
+        future = self.pending.pop(str(path), None)
+        if future:
+            future.result()
+
+    def flush(self):
+        pending = set(self.pending.values())
+        self.pending.clear()
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.flush()
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def move(self, src: Path, dst: Path):
+        # pending moves are keyed by both paths, so a name is only reused once the file that had it has left
+        self.wait(src)
+        self.wait(dst)
+        self._released(src)
+        self._names(dst.parent).add(dst.name)
+        if self.journal is not None:
+            self.journal.append("move", src, dst)
+        if self.executor:
+            future = self.executor.submit(self._journaled, self._move, src, dst)
+            self.pending[str(src)] = future
+            self.pending[str(dst)] = future
+        else:
+            self._journaled(self._move, src, dst)
+
+    def remove(self, path: Path):
+        self.wait(path)
+        self._released(path)
+        if self.journal is not None:
+            self.journal.append("remove", path)
+        self._journaled(os.remove, path)
+
+    def rmdir(self, path: Path):
+        os.rmdir(path)
+        self.known_dirs.discard(str(path))
+        self.taken_names.pop(str(path), None)
+        self._released(path)
+
+    def _journaled(self, operation, *paths: Path):
+        if self.journal is None:
+            operation(*paths)
+            return
+        self.journal.started()
+        try:
+            operation(*paths)
+        finally:
+            self.journal.finished()
+
+    @classmethod
+    def _move(cls, src: Path, dst: Path):
+        with stats.timer("move"):
+            try:
+                os.rename(src, dst)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                cls._move_across_devices(src, dst)
+
+    @classmethod
+    def _move_across_devices(cls, src: Path, dst: Path):
+        tmp_path = Path(os.path.join(dst.parent, f".{dst.name}.tmp"))
+        with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            with stats.timer("copy", size=size):
+                cls._copy_data(fsrc.fileno(), fdst.fileno(), size)
+                os.fsync(fdst.fileno())
+        shutil.copystat(src, tmp_path)
+        os.rename(tmp_path, dst)
+        # the new name must be on disk before the source is gone
+        cls._fsync_dir(dst.parent)
+        os.remove(src)
+
+    @classmethod
+    def _fsync_dir(cls, path: Path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def _copy_data(cls, src_fd: int, dst_fd: int, size: int):
+        # Kernel side copies first, plain reads and writes if neither works between these filesystems
+        for copy in (cls._copy_file_range, cls._sendfile, cls._read_write):
+            try:
+                copy(src_fd, dst_fd, size)
+                return
+            except OSError as e:
+                if copy == cls._read_write or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                    raise
+                os.ftruncate(dst_fd, 0)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+
+    @classmethod
+    def _copy_file_range(cls, src_fd: int, dst_fd: int, size: int):
+        if not hasattr(os, "copy_file_range"):
+            raise OSError(errno.ENOSYS, "copy_file_range not available")
+        offset = 0
+        while offset < size:
+            copied = os.copy_file_range(src_fd, dst_fd, min(COPY_CHUNK_SIZE, size - offset), offset, offset)
+            if not copied:
+                # some filesystems (procfs, FUSE) report end of file early, copy the data another way
+                raise OSError(errno.EINVAL, f"copy_file_range stopped at {offset} of {size} bytes")
+            offset += copied
+
+    @classmethod
+    def _sendfile(cls, src_fd: int, dst_fd: int, size: int):
+        offset = 0
+        while offset < size:
+            copied = os.sendfile(dst_fd, src_fd, offset, min(COPY_CHUNK_SIZE, size - offset))
+            if not copied:
+                raise OSError(errno.EINVAL, f"sendfile stopped at {offset} of {size} bytes")
+            offset += copied
+
+    @classmethod
+    def _read_write(cls, src_fd: int, dst_fd: int, size: int):
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        with open(src_fd, 'rb', closefd=False) as fsrc, open(dst_fd, 'wb', closefd=False) as fdst:
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        copied = os.fstat(dst_fd).st_size
+        if copied != size:
+            raise OSError(errno.EIO, f"Copied {copied} of {size} bytes")
@@ -0,0 +1,136 @@
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from imagehash import ImageHash
+
+
+def hash_to_int(image_hash) -> int:
+    return int(str(image_hash), 16)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+# BK-tree over perceptual hashes, keyed by the same hex strings used in ImageDatabase.by_hash.
+# Nodes are kept in flat lists so the tree pickles without recursion. Removed hashes stay in the
+# tree as routing nodes until the next compaction.
+class HashIndex:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, data_dir: Path, name: str = "hash_index"):
+        self.path = Path(os.path.join(data_dir, f"{name}.pickle"))
+        self._clear()
+
+    def _clear(self):
+        self.keys: List[str] = []
+        self.values: List[int] = []
+        self.children: List[Dict[int, int]] = []
+        self.deleted: List[bool] = []
+        self.nodes_by_key: Dict[str, int] = {}
+        self.live_count = 0
+        self.dirty = True
+
+    def __len__(self):
+        return self.live_count
+
+    def add(self, image_hash: ImageHash):
+        key = str(image_hash)
+        node = self.nodes_by_key.get(key)
+        if node is not None:
+            if self.deleted[node]:
+                self.deleted[node] = False
+                self.live_count += 1
+                self.dirty = True
+            return
+        value = hash_to_int(image_hash)
+        new_node = len(self.keys)
+        self.keys.append(key)
+        self.values.append(value)
+        self.children.append({})
+        self.deleted.append(False)
+        self.nodes_by_key[key] = new_node
+        self.live_count += 1
+        self.dirty = True
+        if new_node == 0:
+            return
+        node = 0
+        while True:
+            dist = hamming(value, self.values[node])
+            child = self.children[node].get(dist)
+            if child is None:
+                self.children[node][dist] = new_node
+                return
+            node = child
+
+    def remove(self, image_hash: ImageHash):
+        node = self.nodes_by_key.get(str(image_hash))
+        if node is not None and not self.deleted[node]:
+            self.deleted[node] = True
+            self.live_count -= 1
+            self.dirty = True
+
+    def find(self, image_hash: ImageHash, max_dist: int) -> Optional[str]:
+        best: Tuple[int, str] = None
+        for dist, key in self.search(image_hash, max_dist):
+            if not best or (dist, key) < best:
+                best = (dist, key)
+        return best[1] if best else None
+
+    def find_many(self, image_hashes: List[ImageHash], max_dist: int) -> List[Optional[str]]:
+        return [self.find(image_hash, max_dist) for image_hash in image_hashes]
+
+    def search(self, image_hash: ImageHash, max_dist: int) -> List[Tuple[int, str]]:
+        if not self.keys:
+            return []
+        value = hash_to_int(image_hash)
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            dist = hamming(value, self.values[node])
+            if dist <= max_dist and not self.deleted[node]:
+                found.append((dist, self.keys[node]))
+            for child_dist, child in self.children[node].items():
+                if dist - max_dist <= child_dist <= dist + max_dist:
+                    stack.append(child)
+        return found
+
+    def compact(self):
+        live_keys = [key for key, deleted in zip(self.keys, self.deleted) if not deleted]
+        self._clear()
+        for key in live_keys:
+            self.add(key)
+
+    def save(self, generation: int):
+        if len(self.keys) > 2 * self.live_count + 1000:
+            self.compact()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((generation, self.keys, self.values, self.children, self.deleted), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def load(self, generation: int) -> bool:
+        if not self.path.exists():
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                saved_generation, keys, values, children, deleted = pickle.load(f)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            self.logger.warning(f"Failed to read hash index {self.path}: {e}")
+            return False
+        if saved_generation != generation:
+            self.logger.warning(f"Hash index {self.path} is stale (generation {saved_generation}, expected {generation})")
+            return False
+        self.keys = keys
+        self.values = values
+        self.children = children
+        self.deleted = deleted
+        self.nodes_by_key = {key: node for node, key in enumerate(keys)}
+        self.live_count = deleted.count(False)
+        self.dirty = False
+        return True
@@ -0,0 +1,50 @@
+from collections import defaultdict
+from typing import Dict, Iterator, List, Tuple
+
+from HashIndex import hamming
+
+
+# Hamming self-join: finds all pairs of hashes within max_dist bits without comparing every pair.
+# The hashes are split in max_dist + 1 blocks of bits. Two hashes that differ in at most max_dist bits
+# have at least one block with no difference (pigeonhole), so only hashes that share the value of a
+# block are compared, and a pair is reported for the first block they share.
+class HashJoin:
+
+    @classmethod
+    def block_masks(cls, bits: int, max_dist: int) -> List[int]:
+        count = min(max_dist + 1, bits)
+        bounds = [bits * i // count for i in range(count + 1)]
+        return [((1 << (end - start)) - 1) << start for start, end in zip(bounds, bounds[1:])]
+
+    @classmethod
+    def pairs(cls, values: List[int], bits: int, max_dist: int, probes: List[Tuple[int, int]] = ()) -> Iterator[Tuple[int, int, int]]:
+        # Yields (i, j, distance) for the pairs of values, and (owner, j, distance) for the probes, e.g.
+        # rotated hashes, which are only compared with the values and not with each other
+        masks = cls.block_masks(bits, max_dist)
+        for block, mask in enumerate(masks):
+            earlier_masks = masks[:block]
+            buckets: Dict[int, List[int]] = defaultdict(list)
+            for i, value in enumerate(values):
+                buckets[value & mask].append(i)
+            for members in buckets.values():
+                for x, i in enumerate(members):
+                    for j in members[x + 1:]:
+                        dist = cls._distance(values[i], values[j], earlier_masks, max_dist)
+                        if dist is not None:
+                            yield i, j, dist
+            for owner, value in probes:
+                for j in buckets.get(value & mask, ()):
+                    if j != owner:
+                        dist = cls._distance(value, values[j], earlier_masks, max_dist)
+                        if dist is not None:
+                            yield owner, j, dist
+
+    @classmethod
+    def _distance(cls, a: int, b: int, earlier_masks: List[int], max_dist: int):
+        diff = a ^ b
+        for mask in earlier_masks:
+            if not diff & mask:
+                # already compared in an earlier block
+                return None
+        dist = hamming(a, b)
+        return dist if dist <= max_dist else None
@@ -0,0 +1,166 @@
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy
+from imagehash import ImageHash
+
+from HashIndex import hash_to_int
+
+WORD_BITS = 64
+WORD_MASK = (1 << WORD_BITS) - 1
+INITIAL_CAPACITY = 1024
+QUERY_CHUNK_CELLS = 4 * 1024 * 1024
+
+_byte_popcount = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.uint8)
+
+
+def popcount(words: numpy.ndarray) -> numpy.ndarray:
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(words)
+    counts = _byte_popcount[words.view(numpy.uint8)]
+    return counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=numpy.uint8)
+
+
+# Every stored hash packed into a memory-mapped uint64 matrix (one row per hash), so a query is
+# a single XOR + popcount over the whole library. Deleting swaps the last row into the hole.
+class HashMatrix:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, data_dir: Path, name: str = "hash_matrix"):
+        self.path = Path(os.path.join(data_dir, f"{name}.npy"))
+        self.meta_path = Path(os.path.join(data_dir, f"{name}.meta"))
+        self.matrix: numpy.ndarray = None
+        self.count = 0
+        self.hex_width: int = None
+        self.rows_by_key: Dict[str, int] = {}
+        self.keys: List[str] = []
+        self.dirty = True
+
+    def __len__(self):
+        return self.count
+
+    def _words(self) -> int:
+        return (self.hex_width * 4 + WORD_BITS - 1) // WORD_BITS
+
+    def _to_words(self, image_hash) -> List[int]:
+        value = hash_to_int(image_hash)
+        return [(value >> (WORD_BITS * i)) & WORD_MASK for i in range(self._words())]
+
+    def _to_key(self, row: numpy.ndarray) -> str:
+        value = 0
+        for i, word in enumerate(row.tolist()):
+            value |= word << (WORD_BITS * i)
+        return f"{value:0{self.hex_width}x}"
+
+    def _write_meta(self, generation: Optional[int]):
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((generation, self.count, self.hex_width), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.meta_path)
+
+    def _mark_dirty(self):
+        # rows are mutated in place, so invalidate the sidecar until the next save
+        if not self.dirty:
+            self._write_meta(None)
+            self.dirty = True
+
+    def _resize(self, capacity: int):
+        tmp_path = f"{self.path}.tmp"
+        matrix = numpy.lib.format.open_memmap(tmp_path, mode="w+", dtype=numpy.uint64, shape=(capacity, self._words()))
+        if self.matrix is not None:
+            matrix[:self.count] = self.matrix[:self.count]
+        matrix.flush()
+        os.replace(tmp_path, self.path)
+        self.matrix = matrix
+
+    def add(self, image_hash: ImageHash):
+        key = str(image_hash)
+        if key in self.rows_by_key:
+            return
+        if self.hex_width is None:
+            self.hex_width = len(key)
+        elif len(key) != self.hex_width:
+            self.logger.warning(f"Not indexing {key}, expected a {self.hex_width * 4} bit hash")
+            return
+        self._mark_dirty()
+        if self.matrix is None or self.count >= self.matrix.shape[0]:
+            self._resize(max(INITIAL_CAPACITY, self.count * 2))
+        self.matrix[self.count] = self._to_words(key)
+        self.rows_by_key[key] = self.count
+        self.keys.append(key)
+        self.count += 1
+
+    def remove(self, image_hash: ImageHash):
+        row = self.rows_by_key.pop(str(image_hash), None)
+        if row is None:
+            return
+        self._mark_dirty()
+        last = self.count - 1
+        if row != last:
+            last_key = self.keys[last]
+            self.matrix[row] = self.matrix[last]
+            self.keys[row] = last_key
+            self.rows_by_key[last_key] = row
+        self.keys.pop()
+        self.count = last
+
+    def find(self, image_hash: ImageHash, max_dist: int) -> Optional[str]:
+        return self.find_many([image_hash], max_dist)[0]
+
+    def find_many(self, image_hashes: List[ImageHash], max_dist: int) -> List[Optional[str]]:
+        found: List[Optional[str]] = [None] * len(image_hashes)
+        if not self.count or not image_hashes:
+            return found
+        queries = []
+        positions = []
+        for i, image_hash in enumerate(image_hashes):
+            if len(str(image_hash)) == self.hex_width:
+                queries.append(self._to_words(image_hash))
+                positions.append(i)
+        if not queries:
+            return found
+        queries = numpy.array(queries, dtype=numpy.uint64)
+        best_dist = numpy.full(len(queries), max_dist + 1, dtype=numpy.int64)
+        best_row = numpy.full(len(queries), -1, dtype=numpy.int64)
+        chunk_rows = max(1, QUERY_CHUNK_CELLS // (len(queries) * queries.shape[1]))
+        for start in range(0, self.count, chunk_rows):
+            rows = self.matrix[start:min(start + chunk_rows, self.count)]
+            dists = popcount(rows[:, None, :] ^ queries[None, :, :]).sum(axis=2, dtype=numpy.int64)
+            chunk_best = dists.argmin(axis=0)
+            chunk_dist = dists[chunk_best, numpy.arange(len(queries))]
+            better = chunk_dist < best_dist
+            best_dist[better] = chunk_dist[better]
+            best_row[better] = chunk_best[better] + start
+        for position, row in zip(positions, best_row.tolist()):
+            if row >= 0:
+                found[position] = self.keys[row]
+        return found
+
+    def save(self, generation: int):
+        if self.matrix is not None:
+            self.matrix.flush()
+        self._write_meta(generation)
+        self.dirty = False
+
+    def load(self, generation: int) -> bool:
+        if not self.path.exists() or not self.meta_path.exists():
+            return False
+        try:
+            with open(self.meta_path, "rb") as f:
+                saved_generation, count, hex_width = pickle.load(f)
+            if saved_generation != generation:
+                self.logger.warning(f"Hash matrix {self.path} is stale (generation {saved_generation}, expected {generation})")
+                return False
+            self.hex_width = hex_width
+            self.matrix = numpy.lib.format.open_memmap(self.path, mode="r+") if hex_width else None
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            self.logger.warning(f"Failed to read hash matrix {self.path}: {e}")
+            return False
+        self.count = count
+        self.keys = [self._to_key(row) for row in self.matrix[:count]] if count else []
+        self.rows_by_key = {key: row for row, key in enumerate(self.keys)}
+        self.dirty = False
+        return True
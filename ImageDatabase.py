@@ -1,35 +1,100 @@
 import logging
 import os
+import time
 from os import path
 from pathlib import Path
-from typing import List, Iterator
+from typing import Dict, List, Iterator, Tuple
 
-import transaction
-from BTrees import OOBTree
-from ZODB import DB
-from ZODB.FileStorage import FileStorage
 from imagehash import ImageHash
 
+from HashIndex import HashIndex
+from HashMatrix import HashMatrix
 from ImageInfo import ImageInfo
+from MoveJournal import MoveJournal
+from RunStats import stats
+from SqliteStorage import SqliteStorage
+from ZodbStorage import ZodbStorage
+
+# modifications per commit when no save_threshold is given, file moves are journaled so a crash
+# between commits only costs replaying the journal
+DEFAULT_SAVE_THRESHOLDS = {
+    "zodb": 500,
+    "sqlite": 1000,
+}
+# also commit once this many bytes of files were added or this many seconds passed since the last commit
+SAVE_BYTES = 1024 * 1024 * 1024
+SAVE_SECONDS = 30.0
 
 
 class ImageDatabase:
     logger = logging.getLogger(__name__)
 
-    def __init__(self, root_dir: Path, save_threshold: int = 10):
+    def __init__(self, root_dir: Path, save_threshold: int = None, hash_index: str = "bktree", backend: str = "zodb"):
         self.root_dir = root_dir
-        self.save_threshold = save_threshold
+        self.save_threshold = save_threshold or DEFAULT_SAVE_THRESHOLDS[backend]
+        self.save_bytes = SAVE_BYTES
+        self.save_seconds = SAVE_SECONDS
+        self.hash_index_type = hash_index
         self.data_dir = self._get_data_dir(self.root_dir)
-        self.storage_path = Path(os.path.join(self.data_dir, "images.db"))
-        init_db = not self.storage_path.exists()
-        self.storage = FileStorage(os.path.join(self.data_dir, "images.db"))
-        self.db = DB(self.storage)
-        self.connection = self.db.open()
-        self.root = self.connection.root
-        if init_db:
-            self.root.by_path = OOBTree.BTree()
-            self.root.by_hash = OOBTree.BTree()
+        self.storage = self._open_storage(backend)
+        self.journal = MoveJournal(self.data_dir)
         self.mod_count = 0
+        self.mod_bytes = 0
+        self.hash_index = self._create_hash_index(False)
+        self.rotated_index = self._create_hash_index(True)
+        # generation of the database the index files on disk match, None when they must be written
+        self.index_generation = self.storage.generation
+        if not self.hash_index.load(self.storage.generation) or not self.rotated_index.load(self.storage.generation):
+            self.hash_index, self.rotated_index = self._build_hash_indexes()
+            self.index_generation = None
+        # counted from here, rebuilding the indexes of a large library takes longer than save_seconds
+        self.saved_at = time.monotonic()
+
+    def _open_storage(self, backend: str):
+        if backend == "zodb":
+            if Path(path.join(self.data_dir, SqliteStorage.file_name)).exists():
+                self.logger.warning(f"{self.data_dir} was migrated to sqlite, its ZODB database is no longer updated")
+            return ZodbStorage(self.data_dir)
+        if backend != "sqlite":
+            raise ValueError(f"Unknown database backend {backend}")
+        if not Path(path.join(self.data_dir, SqliteStorage.file_name)).exists() and Path(path.join(self.data_dir, ZodbStorage.file_name)).exists():
+            self._migrate_to_sqlite()
+        return SqliteStorage(self.data_dir)
+
+    def _migrate_to_sqlite(self):
+        # Migrated under another name and renamed once committed: find_backend() chooses sqlite as soon as
+        # the file exists, so an interrupted migration must leave the ZODB database in use
+        tmp_name = f"{SqliteStorage.file_name}.tmp"
+        for suffix in ("", "-wal", "-shm"):
+            Path(path.join(self.data_dir, tmp_name + suffix)).unlink(missing_ok=True)
+        storage = SqliteStorage(self.data_dir, tmp_name)
+        zodb_storage = ZodbStorage(self.data_dir)
+        try:
+            storage.migrate_from(zodb_storage)
+        finally:
+            zodb_storage.close()
+            storage.close()
+        os.replace(path.join(self.data_dir, tmp_name), path.join(self.data_dir, SqliteStorage.file_name))
+
+    @classmethod
+    def find_backend(cls, root_dir: Path) -> str:
+        return "sqlite" if Path(path.join(root_dir.as_posix(), ".imagesort", SqliteStorage.file_name)).exists() else "zodb"
+
+    @classmethod
+    def open_storage(cls, root_dir: Path):
+        # The records of another library, without its journal and hash indexes. They are only used once
+        # the file operations of an interrupted run there were replayed by opening it as a library.
+        data_dir = cls._get_data_dir(root_dir)
+        if MoveJournal.has_entries(data_dir):
+            raise ValueError(f"{root_dir} has file operations to replay from an interrupted run, open it with audit.py first")
+        if cls.find_backend(root_dir) == "sqlite":
+            return SqliteStorage(data_dir)
+        return ZodbStorage(data_dir)
+
+    @classmethod
+    def exists(cls, root_dir: Path) -> bool:
+        data_dir = path.join(root_dir.as_posix(), ".imagesort")
+        return Path(path.join(data_dir, SqliteStorage.file_name)).exists() or Path(path.join(data_dir, ZodbStorage.file_name)).exists()
 
     @classmethod
     def _get_data_dir(cls, root_dir: Path) -> Path:
@@ -38,45 +103,165 @@ class ImageDatabase:
             data_dir.mkdir(parents=True)
         return data_dir
 
-    def _modified(self):
+    def _create_hash_index(self, rotated: bool):
+        prefix = "rotated_" if rotated else ""
+        if self.hash_index_type == "matrix":
+            return HashMatrix(self.data_dir, f"{prefix}hash_matrix")
+        return HashIndex(self.data_dir, f"{prefix}hash_index")
+
+    def _build_hash_indexes(self):
+        self.logger.info(f"Building {self.hash_index_type} hash indexes")
+        hash_index = self._create_hash_index(False)
+        rotated_index = self._create_hash_index(True)
+        for image in self.all_images():
+            if isinstance(image.hash, ImageHash):
+                hash_index.add(image.hash)
+            for rotated_hash in image.rotated_hashes or []:
+                rotated_index.add(rotated_hash)
+        self.logger.info(f"Indexed {len(hash_index)} image hashes and {len(rotated_index)} rotated hashes")
+        return hash_index, rotated_index
+
+    def _modified(self, size: int = 0):
         self.mod_count = self.mod_count + 1
-        if self.mod_count >= self.save_threshold:
+        self.mod_bytes = self.mod_bytes + size
+
+    def maybe_save(self):
+        # Only called between two file operations: a commit clears the journal, so it must not run
+        # after an operation was journaled and before its result is in the database
+        if self.mod_count >= self.save_threshold or self.mod_bytes >= self.save_bytes or time.monotonic() - self.saved_at >= self.save_seconds:
             self.save()
 
     def save(self, force: bool = False):
-        if self.mod_count or force:
-            transaction.commit()
+        if self.mod_count or len(self.journal) or force:
+            with stats.timer("commit", self.mod_count):
+                self.journal.checkpoint()
+                # the index files are only written by close(), a new generation marks them stale
+                # in case the run ends without it
+                if (self.hash_index.dirty or self.rotated_index.dirty) and self.storage.generation == self.index_generation:
+                    self.storage.generation = self.storage.generation + 1
+                self.storage.commit()
+                self.journal.clear()
             self.mod_count = 0
+            self.mod_bytes = 0
+            self.saved_at = time.monotonic()
+
+    def save_hash_indexes(self):
+        if self.index_generation == self.storage.generation:
+            return
+        with stats.timer("save_hash_indexes"):
+            self.hash_index.save(self.storage.generation)
+            self.rotated_index.save(self.storage.generation)
+        self.index_generation = self.storage.generation
+
+    def close(self):
+        self.save()
+        self.save_hash_indexes()
+        self.journal.close()
+        self.storage.close()
 
     def get_by_path(self, path: Path) -> ImageInfo:
-        return self.root.by_path.get(str(path))
+        return self.storage.get_by_path(str(path))
 
     def get_by_hash(self, hash: ImageHash) -> ImageInfo:
-        return self.root.by_hash.get(str(hash))
+        return self.storage.get_by_hash(str(hash))
+
+    def get_by_rotated_hash(self, hash: ImageHash) -> ImageInfo:
+        return self.storage.get_by_rotated_hash(str(hash))
 
     def add(self, image: ImageInfo):
-        self.root.by_path[str(image.path)] = image
-        self.root.by_hash[str(image.hash)] = image
+        self.storage.put(image)
+        if image.exif is not None:
+            self.storage.set_exif(str(image.path), image.exif)
+        if isinstance(image.hash, ImageHash):
+            self.hash_index.add(image.hash)
+        for rotated_hash in image.rotated_hashes or []:
+            self.rotated_index.add(rotated_hash)
         self.logger.debug(f"Added {image}")
-        self._modified()
+        self._modified(image.size or 0)
 
     def remove(self, image: ImageInfo):
-        try:
-            del self.root.by_path[str(image.path)]
-        except KeyError:
-            pass
-        try:
-            del self.root.by_hash[str(image.hash)]
-        except KeyError:
-            pass
+        self.storage.delete(image)
+        # hashes still stored for another record stay indexed
+        if isinstance(image.hash, ImageHash) and not self.storage.get_by_hash(str(image.hash)):
+            self.hash_index.remove(image.hash)
+        for rotated_hash in image.rotated_hashes or []:
+            if not self.storage.get_by_rotated_hash(str(rotated_hash)):
+                self.rotated_index.remove(rotated_hash)
+        self.remove_file_hashes(image.path)
         self.logger.debug(f"Removed {image}")
         self._modified()
 
+    def find_similar(self, image_hash: ImageHash, max_dist: int) -> ImageInfo:
+        key = self.hash_index.find(image_hash, max_dist)
+        if key:
+            return self.storage.get_by_hash(key)
+
+    def find_similar_rotated(self, image_hash: ImageHash, max_dist: int) -> ImageInfo:
+        key = self.rotated_index.find(image_hash, max_dist)
+        if key:
+            return self.storage.get_by_rotated_hash(key)
+
+    def find_similar_many(self, image_hashes: List[ImageHash], max_dist: int) -> List[ImageInfo]:
+        return [self.storage.get_by_hash(key) if key else None for key in self.hash_index.find_many(image_hashes, max_dist)]
+
+    def find_similar_rotated_many(self, image_hashes: List[ImageHash], max_dist: int) -> List[ImageInfo]:
+        return [self.storage.get_by_rotated_hash(key) if key else None for key in self.rotated_index.find_many(image_hashes, max_dist)]
+
+    def get_exif(self, path: Path) -> Dict:
+        return self.storage.get_exif(str(path))
+
+    def get_by_size(self, size: int) -> List[ImageInfo]:
+        return self.storage.get_by_size(size)
+
+    def get_videos_by_size(self, size: int) -> List[ImageInfo]:
+        return self.storage.get_videos_by_size(size)
+
+    def set_sample(self, image: ImageInfo, sample: str):
+        # records stored before samples were kept get theirs the first time another file has their size
+        image.sample = sample
+        self.storage.put(image)
+        self._modified()
+
+    def get_file_hashes(self, path: Path) -> Tuple:
+        return self.storage.get_file_hashes(str(path))
+
+    def set_file_hashes(self, path: Path, file_hashes: Tuple):
+        self.storage.set_file_hashes(str(path), file_hashes)
+        self._modified()
+
+    def move_file_hashes(self, old_path: Path, new_path: Path):
+        file_hashes = self.storage.get_file_hashes(str(old_path))
+        if file_hashes:
+            self.storage.delete_file_hashes(str(old_path))
+            self.set_file_hashes(new_path, file_hashes)
+
+    def remove_file_hashes(self, path: Path):
+        if self.storage.delete_file_hashes(str(path)):
+            self._modified()
+
+    def get_dir_fingerprint(self, path: Path) -> Tuple:
+        return self.storage.get_dir_fingerprint(str(path))
+
+    def set_dir_fingerprint(self, path: Path, fingerprint: Tuple):
+        if self.storage.get_dir_fingerprint(str(path)) != fingerprint:
+            self.storage.set_dir_fingerprint(str(path), fingerprint)
+            self._modified()
+
+    def clear_dir_fingerprints(self):
+        self.storage.clear_dir_fingerprints()
+        self._modified()
+
+    def count_by_path(self) -> int:
+        return self.storage.count_by_path()
+
+    def count_by_hash(self) -> int:
+        return self.storage.count_by_hash()
+
     def all_images(self) -> Iterator[ImageInfo]:
-        return self.root.by_path.values()
+        return self.storage.all_images()
 
     def all_paths(self) -> Iterator[Path]:
-        return self.root.by_path.keys()
+        return self.storage.all_paths()
 
     def all_hashes(self) -> List[ImageHash]:
-        return self.root.by_hash.keys()
+        return self.storage.all_hashes()
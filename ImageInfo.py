@@ -1,14 +1,19 @@
 from datetime import datetime
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List
 
+import imagehash
 import persistent
 from imagehash import ImageHash
 
 
 class ImageInfo(persistent.Persistent):
+    # Only the fields used to find and compare images are stored with the record, as a tuple. The
+    # full exif is kept in the exif store of ImageDatabase, here it is only set on freshly loaded images.
+    # sample is ImageLoader.sample_hash() of the file, used to find byte-identical files before loading them
+    __slots__ = ("path", "size", "hash", "ts", "width", "height", "hdr", "rotated_hashes", "sample", "exif")
 
-    def __init__(self, path: Path, size: int, hash: ImageHash, ts: datetime, width: int, height: int, exif: Dict = None):
+    def __init__(self, path: Path, size: int, hash: ImageHash, ts: datetime, width: int, height: int, exif: Dict = None, rotated_hashes: List[ImageHash] = None, hdr: bool = None, sample: str = None):
         self.path = path
         self.size = size
         self.hash = hash
@@ -16,6 +21,54 @@ class ImageInfo(persistent.Persistent):
         self.width = width
         self.height = height
         self.exif = exif
+        self.rotated_hashes = rotated_hashes
+        self.hdr = self.is_hdr(exif) if hdr is None else hdr
+        self.sample = sample
+
+    def __getstate__(self):
+        image_hash = str(self.hash) if isinstance(self.hash, ImageHash) else None
+        rotated_hashes = tuple(str(rotated_hash) for rotated_hash in self.rotated_hashes) if self.rotated_hashes else None
+        return str(self.path), self.size, image_hash, None if image_hash else self.hash, self.ts, self.width, self.height, self.hdr, rotated_hashes, self.sample
+
+    def __setstate__(self, state):
+        self.exif = None
+        self.sample = None
+        if isinstance(state, dict):
+            # stored before records were slimmed, the exif is kept until ImageDatabase moves it to its store
+            self.path = state["path"]
+            self.size = state["size"]
+            self.hash = state["hash"]
+            self.ts = state["ts"]
+            self.width = state["width"]
+            self.height = state["height"]
+            self.exif = state.get("exif")
+            self.rotated_hashes = state.get("rotated_hashes")
+            self.hdr = self.is_hdr(self.exif)
+            return
+        path, self.size, image_hash, other_hash, self.ts, self.width, self.height, self.hdr, rotated_hashes = state[:9]
+        # records stored before the sample was added have 9 fields
+        if len(state) > 9:
+            self.sample = state[9]
+        self.path = Path(path)
+        self.hash = imagehash.hex_to_hash(image_hash) if image_hash else other_hash
+        self.rotated_hashes = [imagehash.hex_to_hash(rotated_hash) for rotated_hash in rotated_hashes] if rotated_hashes else None
+
+    def __reduce__(self):
+        # plain pickling, e.g. from the loading processes, keeps the exif, ZODB stores __getstate__() only
+        return _restore, (self.__getstate__(), self.exif)
+
+    @classmethod
+    def is_hdr(cls, exif: Dict) -> bool:
+        if not exif:
+            return False
+        return exif.get('MakerNotes:HDRImageType') == 3 or exif.get('EXIF:CustomRendered') == 3
 
     def __repr__(self):
         return f"{self.hash} {self.path} {self.size} {self.width}x{self.height} {self.ts}"
+
+
+def _restore(state, exif: Dict) -> ImageInfo:
+    image = ImageInfo.__new__(ImageInfo)
+    image.__setstate__(state)
+    image.exif = exif
+    return image
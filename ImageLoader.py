@@ -1,20 +1,35 @@
 import atexit
 import hashlib
 import logging
+import mmap
+import multiprocessing.util
+import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
-import exiftool
 import imagehash
 from PIL import Image
 
+from ExifToolPool import ExifToolPool
 from ImageInfo import ImageInfo
+from RunStats import stats
 
 exif_date_keys = ['EXIF:CreateDate', 'EXIF:DateTimeOriginal', 'EXIF:ModifyDate', 'RIFF:DateTimeOriginal', 'QuickTime:PreviewDate', 'QuickTime:CreateDate', 'QuickTime:ModifyDate', 'QuickTime:TrackCreateDate', 'QuickTime:TrackModifyDate', 'QuickTime:MediaCreateDate', 'QuickTime:MediaModifyDate', 'XMP:DateCreated', 'XMP:CreateDate', 'XMP:ModifyDate']
 exif_width_keys = ['File:ImageWidth', 'RIFF:ImageWidth', 'QuickTime:ImageWidth']
 exif_height_keys = ['File:ImageHeight', 'RIFF:ImageHeight', 'QuickTime:ImageHeight']
+exif_hdr_keys = ['MakerNotes:HDRImageType', 'EXIF:CustomRendered']
+exif_tags = exif_date_keys + exif_width_keys + exif_height_keys + exif_hdr_keys
+# smallest side kept when decoding at reduced resolution for hashing
+FAST_HASH_MIN_SIZE = 256
+# size of the grayscale thumbnail that is rotated to compute the rotated hashes
+ROTATION_THUMB_SIZE = 64
+# videos are identified by their size and a hash of 3 blocks of this size (head, middle, tail)
+SAMPLE_BLOCK_SIZE = 64 * 1024
+DIGEST_CHUNK_SIZE = 8 * 1024 * 1024
 
 
 class ImageLoader:
@@ -23,13 +38,15 @@ class ImageLoader:
 
     logger = logging.getLogger(__name__)
     __instance = None
+    exif_processes = 1
+    exif_batch_size = 50
+    fast_hash = False
 
     def __init__(self):
         if ImageLoader.__instance:
             raise ValueError("This class is a singleton, use ImageLoader.instance()")
-        self.exif_tool = exiftool.ExifTool()
-        self.exif_tool.start()
-        self.logger.info("ExifTool started")
+        self.exif_pool = ExifToolPool(self.exif_processes)
+        self.exif_cache: Dict[str, Dict] = {}
         atexit.register(ImageLoader.terminate)
         ImageLoader.__instance = self
 
@@ -41,11 +58,33 @@ class ImageLoader:
 
     @classmethod
     def terminate(cls):
-        image_loader = ImageLoader.instance()
+        image_loader = ImageLoader.__instance
         if image_loader:
-            if image_loader.exif_tool:
-                image_loader.exif_tool.terminate()
-                cls.logger.info("ExifTool terminated")
+            image_loader.exif_pool.terminate()
+            image_loader.exif_cache.clear()
+
+    @classmethod
+    def load_batch(cls, paths: List[Path]) -> List[ImageInfo]:
+        ImageLoader.instance().prefetch_exif(paths)
+        return [ImageLoader.load(path) for path in paths]
+
+    @classmethod
+    def init_worker(cls, exif_processes: int, exif_batch_size: int, fast_hash: bool):
+        # Workers are started without the state of the main process, the settings are passed again.
+        # A worker that was forked anyway must not share the ExifTool pipes or the stats of its parent.
+        cls.exif_processes = exif_processes
+        cls.exif_batch_size = exif_batch_size
+        cls.fast_hash = fast_hash
+        ImageLoader.__instance = None
+        stats.drain()
+        # workers leave through os._exit, which skips atexit, multiprocessing runs its finalizers before
+        multiprocessing.util.Finalize(None, ImageLoader.terminate, exitpriority=10)
+
+    @classmethod
+    def load_batch_with_stats(cls, paths: List[Path]) -> Tuple[List[ImageInfo], Dict]:
+        # used in worker processes, the stats collected there are merged by the caller
+        images = cls.load_batch(paths)
+        return images, stats.drain()
 
     @classmethod
     def load(cls, path: Path) -> ImageInfo:
@@ -67,26 +106,32 @@ class ImageLoader:
             raise ValueError(f"I don't know how to load {path}")
 
     def load_jpg(self, path: Path) -> ImageInfo:
-        image = Image.open(path.as_posix())
-        image_hash = imagehash.dhash(image, 10)
+        stat = path.stat()
+        with stats.timer("decode", size=stat.st_size):
+            image, (w, h) = self.open_image(path.as_posix(), self.fast_hash)
+            image.load()
+        with stats.timer("dhash"):
+            image_hash = imagehash.dhash(image, 10)
+            rotated_hashes = self.hash_rotations(image)
+        with stats.timer("sample_hash", size=min(stat.st_size, 3 * SAMPLE_BLOCK_SIZE)):
+            sample = self.sample_hash(path.as_posix(), stat.st_size)
         exif: Dict = self.load_exif(path)
         if not exif:
             self.logger.warning(f"No exif info found in {path}")
-        stat = path.stat()
         oldest_dt = self.get_oldest_date(exif, stat, path)
-        w, h = image.size
-        return ImageInfo(path, stat.st_size, image_hash, oldest_dt, w, h, exif)
+        return ImageInfo(path, stat.st_size, image_hash, oldest_dt, w, h, exif, rotated_hashes, sample=sample)
 
     def load_mov(self, path: Path) -> ImageInfo:
-        # hash = imagehash.ImageHash(numpy.asarray(cls.sha(path.as_posix())))
-        image_hash = self.hash_file(path.as_posix())
+        # The full digest is only computed by ImageSorter when another video has the same sample hash
+        stat = path.stat()
+        with stats.timer("sample_hash", size=min(stat.st_size, 3 * SAMPLE_BLOCK_SIZE)):
+            image_hash = self.sample_hash(path.as_posix(), stat.st_size)
         exif: Dict = self.load_exif(path)
         if not exif:
             self.logger.warning(f"No exif info found in {path}")
-        stat = path.stat()
         oldest_dt = self.get_oldest_date(exif, stat, path)
         w, h = self.get_wh(exif)
-        return ImageInfo(path, stat.st_size, image_hash, oldest_dt, w, h, exif)
+        return ImageInfo(path, stat.st_size, image_hash, oldest_dt, w, h, exif, sample=image_hash)
 
     def load_avi(self, path: Path) -> ImageInfo:
         return self.load_mov(path)
@@ -101,7 +146,34 @@ class ImageLoader:
         return self.load_jpg(path)
 
     def load_exif(self, path: Path):
-        return self.exif_tool.get_metadata(path.as_posix())
+        exif = self.exif_cache.pop(path.as_posix(), None)
+        if exif is not None:
+            return exif
+        with self.exif_pool.acquire() as exif_tool, stats.timer("exiftool"):
+            return exif_tool.get_tags(exif_tags, path.as_posix())
+
+    def prefetch_exif(self, paths: List[Path]):
+        filenames = [path.as_posix() for path in paths]
+        batches = [filenames[i:i + self.exif_batch_size] for i in range(0, len(filenames), self.exif_batch_size)]
+        if len(batches) > 1 and self.exif_pool.size > 1:
+            with ThreadPoolExecutor(max_workers=self.exif_pool.size) as executor:
+                list(executor.map(self._prefetch_exif_batch, batches))
+        else:
+            for batch in batches:
+                self._prefetch_exif_batch(batch)
+
+    def _prefetch_exif_batch(self, filenames: List[str]):
+        try:
+            with self.exif_pool.acquire() as exif_tool, stats.timer("exiftool", len(filenames)):
+                results = exif_tool.get_tags_batch(exif_tags, filenames)
+        except ValueError as e:
+            # a single unreadable file fails the whole batch, load_exif will retry them one by one
+            self.logger.warning(f"ExifTool batch of {len(filenames)} files failed: {e}")
+            return
+        for exif in results:
+            source_file = exif.get('SourceFile')
+            if source_file:
+                self.exif_cache[source_file] = exif
 
     @classmethod
     def get_wh(cls, exif: Dict) -> Tuple[int, int]:
@@ -138,25 +210,65 @@ class ImageLoader:
         return oldest_dt
 
     @classmethod
-    def hash_file(cls, filename):
-        if ImageLoader.image_re.match(filename):
-            return cls.hash_image(filename)
-        else:
-            h = hashlib.sha1()
-            with open(filename, 'rb', buffering=0) as f:
-                for b in iter(lambda: f.read(128 * 1024), b''):
-                    h.update(b)
-            return h.hexdigest()
+    def digest_file(cls, filename):
+        h = hashlib.blake2b(digest_size=20)
+        start = time.perf_counter()
+        with open(filename, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if hasattr(m, "madvise"):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(m) as view:
+                        for offset in range(0, size, DIGEST_CHUNK_SIZE):
+                            h.update(view[offset:offset + DIGEST_CHUNK_SIZE])
+        stats.add("digest", time.perf_counter() - start, size=size)
+        return h.hexdigest()
 
     @classmethod
-    def hash_image(cls, filename, size=64):
+    def sample_hash(cls, filename, size: int) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        with open(filename, 'rb') as f:
+            if size <= 3 * SAMPLE_BLOCK_SIZE:
+                h.update(f.read())
+            else:
+                for offset in (0, (size - SAMPLE_BLOCK_SIZE) // 2, size - SAMPLE_BLOCK_SIZE):
+                    f.seek(offset)
+                    h.update(f.read(SAMPLE_BLOCK_SIZE))
+        return f"{size}:{h.hexdigest()}"
+
+    @classmethod
+    def is_sample_hash(cls, image_hash) -> bool:
+        return isinstance(image_hash, str) and ":" in image_hash
+
+    @classmethod
+    def open_image(cls, filename, reduced: bool = False) -> Tuple[Image.Image, Tuple[int, int]]:
+        # The size comes from the header, it is read before any pixels are decoded
         image = Image.open(filename)
-        return imagehash.dhash(image, size)
+        size = image.size
+        if reduced:
+            image = cls.reduce_image(image)
+        return image, size
 
     @classmethod
-    def is_hdr(cls, exif: Dict) -> bool:
-        hdr_image_type = exif.get('MakerNotes:HDRImageType')
-        custom_rendered = exif.get('EXIF:CustomRendered')
-        if hdr_image_type == 3 or custom_rendered == 3:
-            return True
-        return False
+    def reduce_image(cls, image: Image.Image, min_size: int = FAST_HASH_MIN_SIZE) -> Image.Image:
+        if image.format == "JPEG":
+            # decode with DCT scaling at 1/2, 1/4 or 1/8 of the full size
+            image.draft("L", (min_size, min_size))
+            return image
+        factor = min(image.size) // min_size
+        if factor > 1:
+            return image.convert("L").reduce(factor)
+        return image
+
+    @classmethod
+    def hash_rotations(cls, image: Image.Image, size=10) -> List[imagehash.ImageHash]:
+        # 90, 180 and 270 degrees counterclockwise, same as Image.rotate
+        thumb = image.convert("L")
+        thumb.thumbnail((ROTATION_THUMB_SIZE, ROTATION_THUMB_SIZE), Image.LANCZOS)
+        return [imagehash.dhash(thumb.transpose(method), size) for method in (Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270)]
+
+    @classmethod
+    def hash_image(cls, filename, size=64):
+        image = Image.open(filename)
+        return imagehash.dhash(image, size)
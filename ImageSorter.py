@@ -1,72 +1,213 @@
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import logging
+import multiprocessing
 import os
 import time
 from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
 
-import imagehash
 import piexif
 from PIL import Image
 from imagehash import ImageHash
+from tqdm import tqdm
 
+from DirectoryWatcher import DirectoryWatcher
+from FileMover import FileMover
+from HashIndex import hash_to_int
+from HashJoin import HashJoin
 from ImageDatabase import ImageDatabase
 from ImageInfo import ImageInfo
 from ImageLoader import ImageLoader
+from LoadCache import LoadCache, LOAD_CACHE_BYTES
+from Prefetcher import Prefetcher
+from RunStats import stats
 
 SIMILAR_IMAGE_HASH_DIST = 3
+# positions of the cached hashes in the (size, mtime_ns, digest, image hash) tuples of ImageDatabase.file_hashes
+FILE_DIGEST = 2
+FILE_IMAGE_HASH = 3
 OLD_TS = datetime.strptime('1980:02:01 00:00:00', '%Y:%m:%d %H:%M:%S')
+# records of a merged library looked up in the destination indexes at once
+MERGE_BATCH_SIZE = 1000
+# batches of ImageLoader.exif_batch_size * exif_processes files submitted ahead per worker process
+LOAD_BATCHES_PER_WORKER = 2
 
 
 class ImageSorter:
     logger = logging.getLogger(__name__)
 
-    def __init__(self, sorted_dir: Path):
+    def __init__(self, sorted_dir: Path, hash_index: str = "bktree", workers: int = 1, check: str = "incremental", backend: str = "zodb", move_threads: int = 4, progress: bool = False, load_cache_bytes: int = LOAD_CACHE_BYTES):
         if not sorted_dir.exists() or not sorted_dir.is_dir():
             raise ValueError(f"{sorted_dir} does not exist or is not a directory")
         self.sorted_dir = sorted_dir
-        self.db = ImageDatabase(self.sorted_dir)
+        self.db = ImageDatabase(self.sorted_dir, hash_index=hash_index, backend=backend)
         self.recycle_dir = Path(os.path.join(self.db.data_dir, "trash"))
         if not self.recycle_dir.exists():
             self.recycle_dir.mkdir(parents=True)
         self.root_dir = None
-        self.check_db()
-
-    def check_db(self):
-        self.logger.info(f"Verifying database consistency")
-        for image_hash in self.db.all_hashes():
-            image = self.db.get_by_hash(image_hash)
-            if not self.db.get_by_path(image.path):
-                self.logger.warning(f"Missing in images_by_path {image}")
-                self.db.add(image)
-
-        for path in self.db.all_paths():
-            image = self.db.get_by_path(path)
-            if not self.db.get_by_hash(image.hash):
-                self.logger.warning(f"Missing in images_by_hash {image}")
-                self.db.add(image)
-
-        for image in self.db.all_images():
-            if not image.path.exists():
+        self.mover = FileMover(move_threads, self.db.journal)
+        self.prefetcher = Prefetcher()
+        self.load_cache = LoadCache(self.db.data_dir, load_cache_bytes) if load_cache_bytes else None
+        self.workers = workers
+        self.executor = self._create_executor(workers) if workers > 1 else None
+        self.progress = tqdm(unit=" files", dynamic_ncols=True) if progress else None
+        self.progress_bytes = 0
+        self.replay_journal()
+        self.check_db(check)
+
+    @classmethod
+    def _create_executor(cls, workers: int) -> ProcessPoolExecutor:
+        # Not forked: the main process already runs ExifTool, the mover and prefetch threads, and
+        # their pipes and locks must not be copied into the workers
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method), initializer=ImageLoader.init_worker,
+                                   initargs=(ImageLoader.exif_processes, ImageLoader.exif_batch_size, ImageLoader.fast_hash))
+
+    def close(self):
+        if self.progress is not None:
+            self.progress.close()
+            self.progress = None
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        self.mover.close()
+        self.prefetcher.close()
+        if self.load_cache is not None:
+            self.load_cache.close()
+        ImageLoader.terminate()
+        self.db.close()
+
+    def replay_journal(self):
+        # File operations done after the last commit. A move whose destination exists has happened
+        # (destination names are always free when a move is queued), anything else never ran.
+        # There is no commit before the last entry is replayed, the journal keeps them until then.
+        entries = self.db.journal.recovered
+        if not entries:
+            return
+        self.logger.warning(f"Replaying {len(entries)} file operations from the journal")
+        for entry in entries:
+            op, paths = entry[0], [Path(path) for path in entry[1:]]
+            if op == "move" and paths[1].exists():
+                self.logger.info(f"Replaying move of {paths[0]} to {paths[1]}")
+                self.forget(paths[0])
+                if self.is_library_path(paths[1]):
+                    self.forget(paths[1])
+                    self.reload(paths[1], self.load_cache.get_moved(paths[0], paths[1], ImageLoader.fast_hash) if self.load_cache is not None else None)
+            elif op == "remove" and not paths[0].exists():
+                self.logger.info(f"Replaying removal of {paths[0]}")
+                self.forget(paths[0])
+            elif op == "update" and paths[0].exists():
+                self.logger.info(f"Replaying update of {paths[0]}")
+                self.forget(paths[0])
+                self.reload(paths[0])
+        self.db.save(force=True)
+
+    def forget(self, path: Path):
+        image = self.db.get_by_path(path)
+        if image:
+            self.db.remove(image)
+
+    def is_library_path(self, path: Path) -> bool:
+        return self.sorted_dir in path.parents and self.db.data_dir not in path.parents
+
+    def check_db(self, mode: str = "incremental"):
+        if mode == "fast":
+            self.logger.info("Skipping database verification")
+            return
+        self.logger.info(f"Verifying database consistency ({mode})")
+        timings = {}
+        start = time.monotonic()
+        if mode == "full":
+            self.db.clear_dir_fingerprints()
+
+        if mode == "full" or self.db.count_by_path() != self.db.count_by_hash():
+            for image_hash in self.db.all_hashes():
+                image = self.db.get_by_hash(image_hash)
+                if not self.db.get_by_path(image.path):
+                    self.logger.warning(f"Missing in images_by_path {image}")
+                    self.db.add(image)
+
+            for path in self.db.all_paths():
+                image = self.db.get_by_path(path)
+                if not self.db.get_by_hash(image.hash):
+                    self.logger.warning(f"Missing in images_by_hash {image}")
+                    self.db.add(image)
+        timings["indexes"] = time.monotonic() - start
+
+        start = time.monotonic()
+        unchanged_dirs = {}
+        for path in list(self.db.all_paths()):
+            path = Path(path)
+            if mode == "incremental" and self.is_dir_unchanged(path.parent, unchanged_dirs):
+                continue
+            if not path.exists():
+                image = self.db.get_by_path(path)
                 self.logger.warning(f"Deleting missing {image}")
                 self.db.remove(image)
+                self.db.maybe_save()
+        timings["files"] = time.monotonic() - start
 
-        self.check_dir(self.sorted_dir)
+        start = time.monotonic()
+        self.check_dir(self.sorted_dir, mode == "incremental")
+        timings["dirs"] = time.monotonic() - start
+
+        start = time.monotonic()
         self.db.save()
+        timings["save"] = time.monotonic() - start
+        self.logger.info(f"Database verified in {sum(timings.values()):.2f}s (" + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()) + ")")
+
+    @classmethod
+    def dir_fingerprint(cls, path: Path) -> Tuple:
+        # st_nlink only counts the subdirectories, the entry count also changes when a file is added or removed
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_ino, len(os.listdir(path))
+
+    def is_dir_unchanged(self, path: Path, unchanged_dirs: Dict[Path, bool]) -> bool:
+        if path not in unchanged_dirs:
+            saved = self.db.get_dir_fingerprint(path)
+            try:
+                unchanged_dirs[path] = saved is not None and saved[:3] == self.dir_fingerprint(path)
+            except OSError:
+                unchanged_dirs[path] = False
+        return unchanged_dirs[path]
 
-    def check_dir(self, path: Path):
-        for path in path.glob(f"*"):
-            if path.is_dir() and not path.name.startswith("."):
-                self.check_dir(path)
-            elif path.is_file() and ImageLoader.loadable_re.match(path.name):
+    def check_dir(self, path: Path, incremental: bool = False):
+        # A directory whose mtime/inode/entry count match the last verification has the same entries,
+        # so only its subdirectories need to be checked
+        dir_path = path
+        fingerprint = self.dir_fingerprint(dir_path)
+        saved = self.db.get_dir_fingerprint(dir_path)
+        if incremental and saved and saved[:3] == fingerprint:
+            for name in saved[3]:
+                subdir = Path(os.path.join(dir_path, name))
+                if subdir.is_dir():
+                    self.check_dir(subdir, incremental)
+            return
+        subdirs = []
+        for entry in self.scan_dir(dir_path):
+            path = Path(entry.path)
+            if entry.is_dir():
+                subdirs.append(entry.name)
+                self.check_dir(path, incremental)
+            elif ImageLoader.loadable_re.match(entry.name):
                 existing_image = self.db.get_by_path(path)
                 if not existing_image:
                     self.reload(path)
+                    self.db.maybe_save()
+        self.db.set_dir_fingerprint(dir_path, fingerprint + (tuple(subdirs),))
 
-    def reload(self, path: Path):
+    def reload(self, path: Path, reloaded: ImageInfo = None):
         self.logger.info(f"Reloading {path}")
-        reloaded = ImageLoader.load(path)
-        existing = self.db.get_by_hash(reloaded.hash)
+        self.mover.wait(path)
+        if reloaded is None:
+            reloaded = ImageLoader.load(path)
+        if isinstance(reloaded.hash, ImageHash):
+            existing = self.db.get_by_hash(reloaded.hash)
+        else:
+            existing = self.find_existing_video(reloaded)
         if existing and existing.path != path:
             self.logger.warning(f"Reloaded image: {reloaded}")
             self.logger.warning(f"  Matches existing: {existing}")
@@ -87,27 +228,264 @@ class ImageSorter:
             self.root_dir = incoming_dir
 
         self.logger.info(f"Processing DIR {incoming_dir}")
-        for path in incoming_dir.glob(f"*"):
-            if path.is_dir() and not path.name.startswith("."):
+        files = []
+        for entry in self.scan_dir(incoming_dir, ['.picasa.ini', 'desktop.ini']):
+            path = Path(entry.path)
+            if entry.is_dir():
+                self.sort_files(files)
+                files = []
                 self.sort_dir(path)
-            elif path.is_file() and ImageLoader.loadable_re.match(path.name):
-                self.sort_file(path)
-            elif path.is_file() and path.name.lower() in ['.picasa.ini', 'desktop.ini']:
-                os.remove(path)
-                time.sleep(0.1)
+            elif ImageLoader.loadable_re.match(entry.name):
+                files.append(self.cleanup_filename(path))
+            else:
+                self.mover.remove(path)
+        self.sort_files(files)
+        self.mover.flush()
 
         if incoming_dir != self.root_dir and not os.listdir(incoming_dir.as_posix()):
             self.logger.info(f"Deleting empty directory {incoming_dir}")
-            os.rmdir(incoming_dir)
-            time.sleep(0.1)
+            self.mover.rmdir(incoming_dir)
 
         self.db.save()
 
-    def sort_file(self, path: Path):
-        self.logger.info(f"Processing FILE {path}")
-        path = self.cleanup_filename(path)
-        incoming_image = ImageLoader.load(path)
-        existing_image = self.find_existing(incoming_image.hash)
+    def watch(self, incoming_dirs: List[Path], use_inotify: bool = True):
+        # Runs until interrupted, ExifTool, the database and the hash indexes stay open between files
+        watcher = DirectoryWatcher(incoming_dirs, use_inotify)
+        self.logger.info(f"Watching {', '.join(str(path) for path in incoming_dirs)}")
+        try:
+            while True:
+                paths = watcher.wait_ready(1.0)
+                if not paths:
+                    continue
+                try:
+                    self.sort_files([self.cleanup_filename(path) for path in paths])
+                except Exception as e:
+                    self.logger.exception(f"Failed to sort {len(paths)} files: {str(e)}")
+                self.mover.flush()
+                self.db.save()
+                watcher.done(paths)
+        finally:
+            watcher.close()
+
+    @classmethod
+    def scan_dir(cls, dir_path: Path, extra_names: List[str] = ()) -> List[os.DirEntry]:
+        # The file type comes from the directory listing, so entries are only stat'ed for symlinks and
+        # on filesystems that do not report it. Listed up front so the caller can move and delete files.
+        entries = []
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.name.startswith("."):
+                        entries.append(entry)
+                elif (ImageLoader.loadable_re.match(entry.name) or entry.name.lower() in extra_names) and entry.is_file():
+                    entries.append(entry)
+        return entries
+
+    def merge_library(self, library_dir: Path):
+        # The records of a sorted library are used as they are, files are only read again to confirm
+        # exact duplicates before deleting them or when exif is transplanted
+        if not ImageDatabase.exists(library_dir):
+            raise ValueError(f"{library_dir} has no image database, sort it instead")
+        if not self.root_dir:
+            self.root_dir = library_dir
+        source_storage = ImageDatabase.open_storage(library_dir)
+        try:
+            images = [self.copy_image(image, source_storage.get_exif(str(image.path))) for image in source_storage.all_images()]
+            self.logger.info(f"Merging {len(images)} images from {library_dir}")
+            for i in range(0, len(images), MERGE_BATCH_SIZE):
+                batch = images[i:i + MERGE_BATCH_SIZE]
+                with stats.timer("merge_lookup", len(batch)):
+                    matches = self.find_existing_many(batch)
+                for image, existing_image in zip(batch, matches):
+                    self.merge_image(source_storage, image, existing_image)
+                    self.db.maybe_save()
+            source_storage.commit()
+        finally:
+            source_storage.close()
+        # files the library database did not know about are loaded and sorted like any source
+        self.sort_dir(library_dir)
+
+    def merge_image(self, source_storage, image: ImageInfo, existing_image: ImageInfo):
+        file_hashes = source_storage.get_file_hashes(str(image.path))
+        source_image = source_storage.get_by_path(str(image.path))
+        if source_image:
+            source_storage.delete(source_image)
+            source_storage.delete_file_hashes(str(image.path))
+        if not image.path.exists():
+            self.logger.warning(f"Missing in merged library {image}")
+            return
+        if file_hashes:
+            self.db.set_file_hashes(image.path, file_hashes)
+        if existing_image:
+            current_image = self.db.get_by_path(existing_image.path)
+            if current_image and str(current_image.hash) == str(existing_image.hash):
+                existing_image = current_image
+            else:
+                # the match found for the batch was replaced since, look again
+                existing_image = self.find_existing_image(image)
+        elif not existing_image and not isinstance(image.hash, ImageHash):
+            existing_image = self.find_existing_video(image)
+        self.logger.info(f"Processing FILE {image.path}")
+        if not existing_image:
+            self.move_to_sorted(image)
+        else:
+            self.logger.info(f"Found match for incoming image {image}")
+            self.logger.info(f"  With existing image {existing_image}")
+            self.keep_better(existing_image, image)
+        stats.count("merged", 1, image.size)
+        if self.progress is not None:
+            self.update_progress(image.size)
+
+    def find_existing_many(self, images: List[ImageInfo]) -> List[ImageInfo]:
+        # Same lookups as find_existing, each one done for the whole batch. Images of a sorted library
+        # are not similar to each other, so they are looked up against the destination as it is now.
+        found = [self.db.get_by_hash(image.hash) if isinstance(image.hash, ImageHash) else None for image in images]
+        for lookup in (self.db.find_similar_many, self.db.find_similar_rotated_many):
+            missing = [i for i, image in enumerate(images) if not found[i] and isinstance(image.hash, ImageHash)]
+            if not missing:
+                break
+            for i, existing_image in zip(missing, lookup([images[i].hash for i in missing], SIMILAR_IMAGE_HASH_DIST)):
+                found[i] = existing_image
+        return found
+
+    def find_existing_image(self, image: ImageInfo) -> ImageInfo:
+        if isinstance(image.hash, ImageHash):
+            return self.find_existing(image.hash)
+        return self.find_existing_video(image)
+
+    @classmethod
+    def copy_image(cls, image: ImageInfo, exif: Dict, path: Path = None) -> ImageInfo:
+        # records of another database cannot be stored in this one, a path is given for identical files
+        image_hash = image.hash
+        if not isinstance(image_hash, ImageHash) and not ImageLoader.is_sample_hash(image_hash):
+            # stored as a full digest, videos are matched by sample hash first
+            image_hash = ImageLoader.sample_hash(image.path.as_posix(), image.size) if image.path.exists() else image_hash
+        return ImageInfo(Path(path or image.path), image.size, image_hash, image.ts, image.width, image.height, exif, image.rotated_hashes, image.hdr, image.sample)
+
+    def sort_files(self, paths: List[Path]):
+        paths, copies = self.find_identical(paths)
+        for incoming_image in self.load_all(paths):
+            identical_images = [self.copy_image(incoming_image, None, path) for path in copies.get(incoming_image.path, ())]
+            self.sort_image(incoming_image)
+            stats.count("sorted", 1, incoming_image.size)
+            if self.progress is not None:
+                self.update_progress(incoming_image.size)
+            for image in identical_images:
+                self.recycle_identical(image, incoming_image)
+            self.db.maybe_save()
+
+    def find_identical(self, paths: List[Path]) -> Tuple[List[Path], Dict[Path, List[Path]]]:
+        # Byte-identical copies of library files are deleted without being decoded or read by ExifTool.
+        # Files identical to an earlier one of the batch are only loaded once, they are handled after it.
+        # Files are compared by size, then by sample hash and only then by digest.
+        to_load = []
+        copies: Dict[Path, List[Path]] = {}
+        with stats.timer("find_identical", len(paths)):
+            sizes = {}
+            for path in paths:
+                try:
+                    sizes[path] = path.stat().st_size
+                except OSError:
+                    sizes[path] = None
+            batch_sizes = Counter(sizes.values())
+            firsts: Dict[Tuple[int, str], List[Path]] = {}
+            for path in paths:
+                size = sizes[path]
+                if not size:
+                    to_load.append(path)
+                    continue
+                sample = None
+                candidates = [image for image in self.db.get_by_size(size) if image.path != path]
+                if candidates:
+                    sample = ImageLoader.sample_hash(path.as_posix(), size)
+                    existing_image = self.find_identical_existing(path, sample, candidates)
+                    if existing_image:
+                        self.recycle_identical(self.copy_image(existing_image, None, path), existing_image)
+                        self.db.maybe_save()
+                        continue
+                if batch_sizes[size] > 1:
+                    sample = sample or ImageLoader.sample_hash(path.as_posix(), size)
+                    same_sample = firsts.setdefault((size, sample), [])
+                    first = next((first for first in same_sample if self.file_hash(first, FILE_DIGEST) == self.file_hash(path, FILE_DIGEST)), None)
+                    if first:
+                        copies.setdefault(first, []).append(path)
+                        continue
+                    same_sample.append(path)
+                to_load.append(path)
+        return to_load, copies
+
+    def find_identical_existing(self, path: Path, sample: str, candidates: List[ImageInfo]) -> ImageInfo:
+        for existing_image in candidates:
+            if existing_image.sample is None:
+                self.mover.wait(existing_image.path)
+                try:
+                    self.db.set_sample(existing_image, ImageLoader.sample_hash(existing_image.path.as_posix(), existing_image.size))
+                except OSError as e:
+                    self.logger.warning(f"Failed to read {existing_image.path}: {e}")
+                    continue
+            if existing_image.sample == sample and self.file_hash(existing_image.path, FILE_DIGEST) == self.file_hash(path, FILE_DIGEST):
+                return existing_image
+
+    def recycle_identical(self, image: ImageInfo, existing_image: ImageInfo):
+        self.logger.info(f"Processing FILE {image.path}")
+        self.logger.info(f"Identical to existing image {existing_image}")
+        self.recycle(image)
+        stats.count("identical", 1, image.size)
+        if self.progress is not None:
+            self.update_progress(image.size)
+
+    def update_progress(self, size: int):
+        self.progress_bytes += size
+        elapsed = self.progress.format_dict["elapsed"]
+        if elapsed:
+            self.progress.set_postfix_str(f"{self.progress_bytes / elapsed / 1e6:.1f} MB/s", refresh=False)
+        self.progress.update()
+
+    def load_all(self, paths: List[Path]) -> Iterator[ImageInfo]:
+        # Files loaded by an earlier, interrupted run come from the load cache, in the same order
+        if self.load_cache is None:
+            yield from self.load_batches(paths)
+            return
+        cached = self.load_cache.get_many(paths, ImageLoader.fast_hash)
+        loaded = self.load_batches([path for path in paths if path not in cached])
+        for path in paths:
+            yield cached[path] if path in cached else next(loaded)
+
+    def load_batches(self, paths: List[Path]) -> Iterator[ImageInfo]:
+        # Loading runs in the worker processes, results are consumed in submission order so that
+        # duplicate resolution and db commits stay deterministic
+        batch_size = ImageLoader.exif_batch_size * ImageLoader.exif_processes
+        batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+        if not self.executor:
+            for i, batch in enumerate(batches):
+                # read while ExifTool parses the batch, then the next batch while this one is decoded
+                self.prefetcher.prefetch(batch + (batches[i + 1] if i + 1 < len(batches) else []))
+                yield from self.cache_loads(ImageLoader.load_batch(batch))
+            return
+        pending = deque()
+        for batch in batches:
+            self.prefetcher.prefetch(batch)
+            pending.append(self.executor.submit(ImageLoader.load_batch_with_stats, batch))
+            if len(pending) >= self.workers * LOAD_BATCHES_PER_WORKER:
+                yield from self.cache_loads(self.merge_stats(*pending.popleft().result()))
+        while pending:
+            yield from self.cache_loads(self.merge_stats(*pending.popleft().result()))
+
+    def cache_loads(self, images: List[ImageInfo]) -> List[ImageInfo]:
+        if self.load_cache is not None:
+            with stats.timer("load_cache", len(images)):
+                self.load_cache.put_many(images, ImageLoader.fast_hash)
+        return images
+
+    @classmethod
+    def merge_stats(cls, images: List[ImageInfo], worker_stats: Dict) -> List[ImageInfo]:
+        stats.merge(worker_stats)
+        return images
+
+    def sort_image(self, incoming_image: ImageInfo):
+        self.logger.info(f"Processing FILE {incoming_image.path}")
+        with stats.timer("find_existing"):
+            existing_image = self.find_existing_image(incoming_image)
         if not existing_image:
             self.move_to_sorted(incoming_image)
         else:
@@ -131,31 +509,71 @@ class ImageSorter:
             similar_match = self.find_similar(incoming_hash)
             if similar_match:
                 return similar_match
+            rotated_match = self.db.get_by_rotated_hash(incoming_hash) or self.db.find_similar_rotated(incoming_hash, SIMILAR_IMAGE_HASH_DIST)
+            if rotated_match:
+                self.logger.info(f"Rotated version of existing image {rotated_match}")
+                return rotated_match
+
+    def find_existing_video(self, incoming_video: ImageInfo) -> ImageInfo:
+        # Videos are compared by size, then by sample hash, and only then by full digest
+        for existing_video in self.db.get_videos_by_size(incoming_video.size):
+            if existing_video.path == incoming_video.path:
+                continue
+            existing_sample = existing_video.hash
+            if not ImageLoader.is_sample_hash(existing_sample):
+                existing_sample = ImageLoader.sample_hash(existing_video.path.as_posix(), existing_video.size)
+            if existing_sample != incoming_video.hash:
+                continue
+            if self.file_hash(existing_video.path, FILE_DIGEST) == self.file_hash(incoming_video.path, FILE_DIGEST):
+                return existing_video
+        if self.db.get_by_hash(incoming_video.hash):
+            # same size and samples but different content, key it by the full digest instead
+            incoming_video.hash = self.file_hash(incoming_video.path, FILE_DIGEST)
 
     def find_similar(self, incoming_hash: ImageHash) -> ImageInfo:
-        for image in self.db.all_images():
-            existing_hash = image.hash
-            if isinstance(existing_hash, ImageHash):
-                dist = existing_hash - incoming_hash
-                if dist <= SIMILAR_IMAGE_HASH_DIST:
-                    return image
+        with stats.timer("find_similar"):
+            return self.db.find_similar(incoming_hash, SIMILAR_IMAGE_HASH_DIST)
 
     def move_to_sorted(self, incoming_image: ImageInfo):
         self.sort_to(self.sorted_dir, incoming_image, True)
 
     def recycle(self, image: ImageInfo):
         existing_image = self.db.get_by_hash(image.hash)
-        if existing_image:
-            prune_hash = ImageLoader.hash_file(image.path.as_posix())
-            existing_hash = ImageLoader.hash_file(existing_image.path.as_posix())
-            if prune_hash == existing_hash:
-                self.logger.info(f"Deleting {image}")
-                self.logger.info(f"  Matches {existing_image}")
-                os.remove(image.path)
-                time.sleep(0.1)
-                return
+        if existing_image and self.is_same_content(image.path, existing_image.path):
+            self.logger.info(f"Deleting {image}")
+            self.logger.info(f"  Matches {existing_image}")
+            self.mover.remove(image.path)
+            self.db.remove_file_hashes(image.path)
+            return
         self.logger.debug(f"Recycling {image}")
         self.sort_to(self.recycle_dir, image, False)
+        self.db.remove_file_hashes(image.path)
+
+    def is_same_content(self, path1: Path, path2: Path) -> bool:
+        self.mover.wait(path1)
+        self.mover.wait(path2)
+        if path1.stat().st_size == path2.stat().st_size:
+            if self.file_hash(path1, FILE_DIGEST) == self.file_hash(path2, FILE_DIGEST):
+                return True
+        if not ImageLoader.image_re.match(path1.name) or not ImageLoader.image_re.match(path2.name):
+            return False
+        return self.file_hash(path1, FILE_IMAGE_HASH) == self.file_hash(path2, FILE_IMAGE_HASH)
+
+    def file_hash(self, path: Path, kind: int) -> str:
+        # Cached until the size or mtime of the file changes, e.g. after an exif transplant
+        self.mover.wait(path)
+        stat = path.stat()
+        file_hashes = self.db.get_file_hashes(path)
+        if not file_hashes or file_hashes[:2] != (stat.st_size, stat.st_mtime_ns):
+            file_hashes = (stat.st_size, stat.st_mtime_ns, None, None)
+        if file_hashes[kind] is None:
+            if kind == FILE_DIGEST:
+                value = ImageLoader.digest_file(path.as_posix())
+            else:
+                value = str(ImageLoader.hash_image(path.as_posix()))
+            file_hashes = file_hashes[:kind] + (value,) + file_hashes[kind + 1:]
+            self.db.set_file_hashes(path, file_hashes)
+        return file_hashes[kind]
 
     def sort_to(self, root_dir: Path, incoming_image: ImageInfo, check_rotated: bool):
         ext = incoming_image.path.name[-4:].lower()
@@ -163,8 +581,8 @@ class ImageSorter:
         month = incoming_image.ts.strftime("%m")
         new_name = incoming_image.ts.strftime(f"%Y%m%d-%H%M%S-0{ext}")
         new_path = Path(os.path.join(root_dir, year, month, new_name))
-        new_path.parent.mkdir(parents=True, exist_ok=True)
-        if new_path.exists():
+        self.mover.ensure_dir(new_path.parent)
+        if self.mover.is_taken(new_path):
             if check_rotated and ImageLoader.image_re.match(incoming_image.path.name):
                 self.logger.info(f"{new_path} already exists! Checking for rotated images...")
                 existing_image = self.find_rotated(incoming_image)
@@ -176,24 +594,111 @@ class ImageSorter:
             for i in range(1, 100):
                 new_name = incoming_image.ts.strftime(f"%Y%m%d-%H%M%S-{i}{ext}")
                 new_path = Path(os.path.join(root_dir, year, month, new_name))
-                if not new_path.exists():
+                if not self.mover.is_taken(new_path):
                     break
         self.logger.info(f"Moving {incoming_image.path} to {new_path}")
-        os.rename(incoming_image.path, new_path)
+        self.mover.move(incoming_image.path, new_path)
+        self.db.move_file_hashes(incoming_image.path, new_path)
         incoming_image.path = new_path
         if root_dir == self.sorted_dir:
             self.db.add(incoming_image)
 
     def find_rotated(self, incoming_image: ImageInfo) -> ImageInfo:
-        image: Image = Image.open(incoming_image.path.as_posix())
-        for i in range(0, 3):
-            image = image.rotate(90, expand=True)
-            image_hash = imagehash.dhash(image, 10)
-            existing_image = self.find_existing(image_hash)
+        # Existing images stored before rotated hashes were indexed are only found by rotating the incoming one
+        rotated_hashes = incoming_image.rotated_hashes
+        if not rotated_hashes:
+            rotated_hashes = ImageLoader.hash_rotations(Image.open(incoming_image.path.as_posix()))
+        for image_hash in rotated_hashes:
+            existing_image = self.db.get_by_hash(image_hash)
             if existing_image:
                 return existing_image
+        for existing_image in self.db.find_similar_many(rotated_hashes, SIMILAR_IMAGE_HASH_DIST):
+            if existing_image:
+                return existing_image
+
+    def find_clusters(self, max_dist: int = SIMILAR_IMAGE_HASH_DIST) -> List[List[ImageInfo]]:
+        # Groups the library images matched the way find_existing matches an incoming image, by hash
+        # and by the rotated hashes of the other image, joined by HashJoin instead of one lookup per image
+        images = sorted((image for image in self.db.all_images() if isinstance(image.hash, ImageHash)), key=lambda image: str(image.path))
+        if not images:
+            return []
+        with stats.timer("hash_join", len(images)):
+            values = [hash_to_int(image.hash) for image in images]
+            rotated = [(j, hash_to_int(rotated_hash)) for j, image in enumerate(images) for rotated_hash in image.rotated_hashes or []]
+            parents = list(range(len(images)))
+
+            def find(i: int) -> int:
+                while parents[i] != i:
+                    parents[i] = parents[parents[i]]
+                    i = parents[i]
+                return i
+
+            # the rotated hashes are the probes, a match (j, i) means image i is a rotated version of image j
+            for i, j, dist in HashJoin.pairs(values, images[0].hash.hash.size, max_dist, rotated):
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+        clusters: Dict[int, List[ImageInfo]] = {}
+        for i, image in enumerate(images):
+            clusters.setdefault(find(i), []).append(image)
+        return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+    def audit_library(self, max_dist: int = SIMILAR_IMAGE_HASH_DIST) -> List[Dict]:
+        # Near duplicates already in the library, with the image find_better keeps for each cluster.
+        # Clusters are built transitively, so only the images within max_dist of the kept one are removed.
+        report = []
+        for cluster in self.find_clusters(max_dist):
+            best = cluster[0]
+            for image in cluster[1:]:
+                best = self.find_better(best, image)
+            removed = []
+            kept = []
+            for image in cluster:
+                if image is best:
+                    continue
+                dist = self.image_distance(best, image)
+                if dist <= max_dist:
+                    removed.append({"path": str(image.path), "distance": dist, "size": image.size, "width": image.width, "height": image.height, "ts": image.ts.isoformat()})
+                else:
+                    kept.append(str(image.path))
+            if removed:
+                report.append({"keep": str(best.path), "size": best.size, "width": best.width, "height": best.height, "ts": best.ts.isoformat(), "remove": removed, "not_similar_to_kept": kept})
+        return report
+
+    def apply_audit(self, report: List[Dict]):
+        for cluster in report:
+            # both files are read or moved below, so finish the queued moves first
+            self.mover.flush()
+            for removed in cluster["remove"]:
+                # the kept image is read again, an exif transplant replaces its record
+                best = self.db.get_by_path(Path(cluster["keep"]))
+                image = self.db.get_by_path(Path(removed["path"]))
+                if not best or not image:
+                    self.logger.warning(f"Skipping {removed['path']}, the database changed since the audit")
+                    continue
+                self.logger.info(f"Found match for existing image {image}")
+                self.logger.info(f"  With existing image {best}")
+                self.db.remove(image)
+                if not self.db.get_by_hash(best.hash):
+                    # both had the same hash and its entry was the removed image's
+                    self.db.add(best)
+                # recycle() finds the kept image by hash and deletes the file if the content is the same
+                self.keep_existing(best, image)
+                stats.count("audit_removed", 1, image.size)
+                self.db.maybe_save()
+        self.mover.flush()
+        self.db.save()
+
+    @classmethod
+    def image_distance(cls, image1: ImageInfo, image2: ImageInfo) -> int:
+        distances = [image1.hash - image2.hash]
+        distances += [image1.hash - rotated_hash for rotated_hash in image2.rotated_hashes or []]
+        distances += [image2.hash - rotated_hash for rotated_hash in image1.rotated_hashes or []]
+        return int(min(distances))
 
     def keep_better(self, existing_image: ImageInfo, incoming_image: ImageInfo):
+        # both files are read or moved below, so finish the queued moves first
+        self.mover.flush()
         better = self.find_better(existing_image, incoming_image)
         if existing_image == better:
             self.keep_existing(existing_image, incoming_image)
@@ -204,8 +709,8 @@ class ImageSorter:
     def find_better(cls, image1: ImageInfo, image2: ImageInfo):
         pixels1 = image1.width * image1.height
         pixels2 = image2.width * image2.height
-        is_hdr1 = ImageLoader.is_hdr(image1.exif)
-        is_hdr2 = ImageLoader.is_hdr(image2.exif)
+        is_hdr1 = image1.hdr
+        is_hdr2 = image2.hdr
         if pixels1 == pixels2 and (is_hdr1 or is_hdr2):
             if is_hdr1:
                 return image1
@@ -222,7 +727,8 @@ class ImageSorter:
         if existing_image.path.name.lower().endswith(".jpg") and incoming_image.ts > OLD_TS and incoming_image.ts < existing_image.ts:
             self.logger.info(f"  But preserving incoming's exif: {incoming_image}")
             try:
-                piexif.transplant(incoming_image.path.as_posix(), existing_image.path.as_posix())
+                with self.db.journal.record("update", existing_image.path):
+                    piexif.transplant(incoming_image.path.as_posix(), existing_image.path.as_posix())
             except ValueError as e:
                 self.logger.warning(f"Failed to transplant exif: {e}")
             self.reload(existing_image.path)
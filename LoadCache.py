@@ -0,0 +1,122 @@
+import logging
+import os
+import pickle
+import sqlite3
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from ImageInfo import ImageInfo
+from RunStats import stats
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS loads (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    fast_hash INTEGER NOT NULL,
+    image BLOB NOT NULL,
+    used INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS loads_used ON loads (used);
+"""
+# upper bound of the pickled images kept, the least recently used are evicted first
+LOAD_CACHE_BYTES = 256 * 1024 * 1024
+
+
+# Images loaded from the sources, kept across runs so that an interrupted import does not decode,
+# hash and run ExifTool again on the files it had already loaded. An entry is only used while the
+# file has the same size, mtime and inode, and was hashed with the same ImageLoader.fast_hash setting.
+class LoadCache:
+    logger = logging.getLogger(__name__)
+    file_name = "load_cache.sqlite"
+
+    def __init__(self, data_dir: Path, max_bytes: int = LOAD_CACHE_BYTES):
+        self.path = Path(os.path.join(data_dir, self.file_name))
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(self.path.as_posix(), isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.size, self.used = self.connection.execute("SELECT COALESCE(SUM(LENGTH(image)), 0), COALESCE(MAX(used), 0) FROM loads").fetchone()
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def _key(cls, path: Path) -> Tuple:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def get_many(self, paths: List[Path], fast_hash: bool) -> Dict[Path, ImageInfo]:
+        found = {}
+        self.connection.execute("BEGIN")
+        try:
+            for path in paths:
+                image = self._get(path, path, fast_hash)
+                if image:
+                    found[path] = image
+        finally:
+            self.connection.execute("COMMIT")
+        if found:
+            stats.count("load_cache_hit", len(found))
+        return found
+
+    def get_moved(self, old_path: Path, path: Path, fast_hash: bool) -> Optional[ImageInfo]:
+        # a rename keeps the size, mtime and inode, so files moved before the database was committed
+        # are found by their old path
+        self.connection.execute("BEGIN")
+        try:
+            image = self._get(old_path, path, fast_hash)
+        finally:
+            self.connection.execute("COMMIT")
+        if image:
+            stats.count("load_cache_hit")
+        return image
+
+    def _get(self, cached_path: Path, path: Path, fast_hash: bool) -> Optional[ImageInfo]:
+        row = self.connection.execute("SELECT size, mtime_ns, ino, fast_hash, image FROM loads WHERE path = ?", (os.path.abspath(cached_path),)).fetchone()
+        if not row:
+            return None
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+        if row[:3] != key or row[3] != int(fast_hash):
+            return None
+        image = pickle.loads(row[4])
+        # the file may have been given as a relative path
+        image.path = path
+        self.used += 1
+        self.connection.execute("UPDATE loads SET used = ? WHERE path = ?", (self.used, os.path.abspath(cached_path)))
+        return image
+
+    def put_many(self, images: List[ImageInfo], fast_hash: bool):
+        self.connection.execute("BEGIN")
+        try:
+            for image in images:
+                try:
+                    key = self._key(image.path)
+                except OSError:
+                    continue
+                path = os.path.abspath(image.path)
+                data = pickle.dumps(image, protocol=pickle.HIGHEST_PROTOCOL)
+                row = self.connection.execute("SELECT LENGTH(image) FROM loads WHERE path = ?", (path,)).fetchone()
+                self.size += len(data) - (row[0] if row else 0)
+                self.used += 1
+                self.connection.execute("INSERT OR REPLACE INTO loads VALUES (?, ?, ?, ?, ?, ?, ?)", (path,) + key + (int(fast_hash), data, self.used))
+            if self.size > self.max_bytes:
+                self._evict()
+        finally:
+            self.connection.execute("COMMIT")
+
+    def _evict(self):
+        # down to 90% of the limit, so that eviction does not run again on every batch
+        evicted = 0
+        for path, length in self.connection.execute("SELECT path, LENGTH(image) FROM loads ORDER BY used").fetchall():
+            if self.size <= self.max_bytes * 0.9:
+                break
+            self.connection.execute("DELETE FROM loads WHERE path = ?", (path,))
+            self.size -= length
+            evicted += 1
+        self.logger.debug(f"Evicted {evicted} loads from {self.path}")
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Tuple
+
+JOURNAL_NAME = "journal"
+
+
+# Write-ahead log of the file operations done since the last database commit. An entry is written
+# before its operation runs and the journal is emptied once a commit has recorded the result, so
+# after a crash the entries left describe exactly the files whose state the database may not know.
+class MoveJournal:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, data_dir: Path):
+        self.path = Path(os.path.join(data_dir, JOURNAL_NAME))
+        self.recovered = self._read()
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.lock = threading.Condition()
+        self.count = len(self.recovered)
+        self.unsynced = False
+        self.running = 0
+
+    @classmethod
+    def has_entries(cls, data_dir: Path) -> bool:
+        path = Path(os.path.join(data_dir, JOURNAL_NAME))
+        return path.exists() and path.stat().st_size > 0
+
+    def _read(self) -> List[Tuple]:
+        if not self.path.exists():
+            return []
+        entries = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(tuple(json.loads(line)))
+                except ValueError:
+                    # the last line may be cut short by the crash, its operation never started
+                    self.logger.warning(f"Ignoring incomplete journal entry {line.strip()}")
+        if entries:
+            self.logger.warning(f"Found {len(entries)} file operations not recorded in the database")
+        return entries
+
+    def __len__(self):
+        return self.count
+
+    def append(self, op: str, *paths: Path):
+        with self.lock:
+            self.file.write(json.dumps([op] + [str(path) for path in paths]) + "\n")
+            self.file.flush()
+            self.count += 1
+            self.unsynced = True
+            self.running += 1
+
+    @contextmanager
+    def record(self, op: str, *paths: Path):
+        self.append(op, *paths)
+        self.started()
+        try:
+            yield
+        finally:
+            self.finished()
+
+    def started(self):
+        # several queued operations share one fsync
+        with self.lock:
+            if self.unsynced:
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+
+    def finished(self):
+        with self.lock:
+            self.running -= 1
+            self.lock.notify_all()
+
+    def checkpoint(self):
+        # the database is about to be committed, the operations it records must have happened
+        with self.lock:
+            while self.running:
+                self.lock.wait()
+
+    def clear(self):
+        with self.lock:
+            self.file.truncate(0)
+            self.file.flush()
+            self.count = 0
+            self.recovered = []
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,79 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from ImageLoader import ImageLoader, SAMPLE_BLOCK_SIZE
+
+# upper bound of the bytes requested ahead of the batch being loaded
+PREFETCH_BYTES = 128 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+# Asks the kernel to read the next files while the current ones are decoded and hashed. Images are
+# read whole, videos only where ImageLoader.sample_hash reads them.
+class Prefetcher:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, max_bytes: int = PREFETCH_BYTES):
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.next_paths: Optional[List[Path]] = None
+        self.running = False
+
+    def prefetch(self, paths: List[Path]):
+        # a single slot: when the reader falls behind, batches it did not start are replaced by the newest one
+        with self.lock:
+            self.next_paths = paths
+            if not self.running:
+                self.running = True
+                self.executor.submit(self._run)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                paths = self.next_paths
+                self.next_paths = None
+                if paths is None:
+                    self.running = False
+                    return
+            self._prefetch(paths, self.max_bytes)
+
+    def close(self):
+        with self.lock:
+            self.next_paths = None
+        self.executor.shutdown()
+
+    @classmethod
+    def _prefetch(cls, paths: List[Path], max_bytes: int):
+        for path in paths:
+            if max_bytes <= 0:
+                return
+            try:
+                with open(path, 'rb', buffering=0) as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if ImageLoader.image_re.match(path.name) or size <= 3 * SAMPLE_BLOCK_SIZE:
+                        ranges = [(0, size)]
+                    else:
+                        ranges = [(offset, SAMPLE_BLOCK_SIZE) for offset in (0, (size - SAMPLE_BLOCK_SIZE) // 2, size - SAMPLE_BLOCK_SIZE)]
+                    for offset, length in ranges:
+                        cls._read_ahead(f, offset, min(length, max_bytes))
+                        max_bytes -= length
+            except OSError as e:
+                cls.logger.debug(f"Failed to prefetch {path}: {e}")
+
+    @classmethod
+    def _read_ahead(cls, f, offset: int, length: int):
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+            return
+        # no readahead hint on this platform, reading the bytes fills the page cache the same way
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(READ_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
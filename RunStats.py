@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict
+
+PROMETHEUS_PREFIX = "imagesort"
+
+
+# Counters and timers per stage. Worker processes have their own copy, ImageSorter merges what
+# they drain() into the copy of the main process.
+class RunStats:
+    logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.items: Dict[str, int] = defaultdict(int)
+        self.bytes: Dict[str, int] = defaultdict(int)
+
+    @contextmanager
+    def timer(self, stage: str, items: int = 1, size: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, items, size)
+
+    def add(self, stage: str, seconds: float, items: int = 1, size: int = 0):
+        with self.lock:
+            self.calls[stage] += 1
+            self.seconds[stage] += seconds
+            self.items[stage] += items
+            self.bytes[stage] += size
+
+    def count(self, stage: str, items: int = 1, size: int = 0):
+        self.add(stage, 0.0, items, size)
+
+    def drain(self) -> Dict:
+        with self.lock:
+            drained = {"calls": dict(self.calls), "seconds": dict(self.seconds), "items": dict(self.items), "bytes": dict(self.bytes)}
+            self.calls.clear()
+            self.seconds.clear()
+            self.items.clear()
+            self.bytes.clear()
+        return drained
+
+    def merge(self, drained: Dict):
+        with self.lock:
+            for name in ("calls", "seconds", "items", "bytes"):
+                values = getattr(self, name)
+                for stage, value in drained[name].items():
+                    values[stage] += value
+
+    def summary(self) -> Dict:
+        with self.lock:
+            elapsed = time.time() - self.started
+            stages = {}
+            for stage in sorted(self.calls):
+                seconds = self.seconds[stage]
+                stages[stage] = {
+                    "calls": self.calls[stage],
+                    "items": self.items[stage],
+                    "bytes": self.bytes[stage],
+                    "seconds": seconds,
+                    "items_per_s": self.items[stage] / seconds if seconds else None,
+                }
+        return {"started": self.started, "elapsed_seconds": elapsed, "stages": stages}
+
+    def log_summary(self):
+        summary = self.summary()
+        self.logger.info(f"Run finished in {summary['elapsed_seconds']:.2f}s")
+        for stage, values in summary["stages"].items():
+            rate = f", {values['items_per_s']:.1f}/s" if values["items_per_s"] else ""
+            self.logger.info(f"  {stage}: {values['items']} items in {values['calls']} calls, {values['seconds']:.2f}s{rate}")
+
+    def write(self, path: str):
+        # .prom files are written in the Prometheus textfile collector format, anything else as JSON
+        summary = self.summary()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus(summary))
+            else:
+                json.dump(summary, f, indent=2)
+        os.replace(tmp_path, path)
+        self.logger.info(f"Run statistics written to {path}")
+
+    @classmethod
+    def to_prometheus(cls, summary: Dict) -> str:
+        lines = [
+            f"# TYPE {PROMETHEUS_PREFIX}_run_seconds gauge",
+            f"{PROMETHEUS_PREFIX}_run_seconds {summary['elapsed_seconds']:.6f}",
+            f"# TYPE {PROMETHEUS_PREFIX}_run_started_timestamp_seconds gauge",
+            f"{PROMETHEUS_PREFIX}_run_started_timestamp_seconds {summary['started']:.3f}",
+        ]
+        for metric in ("calls", "items", "bytes", "seconds"):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_{metric}_total counter")
+            for stage, values in summary["stages"].items():
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_{metric}_total{{stage="{stage}"}} {values[metric]}')
+        return "\n".join(lines) + "\n"
+
+
+stats = RunStats()
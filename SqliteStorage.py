@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import imagehash
+from imagehash import ImageHash
+
+from ImageInfo import ImageInfo
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    is_video INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    ts TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    rotated_hashes TEXT,
+    hdr INTEGER,
+    sample TEXT
+);
+CREATE INDEX IF NOT EXISTS images_hash ON images (hash);
+CREATE INDEX IF NOT EXISTS images_size ON images (size);
+CREATE INDEX IF NOT EXISTS images_ts ON images (ts);
+CREATE TABLE IF NOT EXISTS by_hash (hash TEXT PRIMARY KEY, path TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS by_hash_path ON by_hash (path);
+CREATE TABLE IF NOT EXISTS by_rotated_hash (hash TEXT PRIMARY KEY, path TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS by_rotated_hash_path ON by_rotated_hash (path);
+CREATE TABLE IF NOT EXISTS exif (path TEXT PRIMARY KEY, exif TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT, image_hash TEXT);
+CREATE TABLE IF NOT EXISTS dir_fingerprints (path TEXT PRIMARY KEY, mtime_ns INTEGER, ino INTEGER, entries INTEGER, subdirs TEXT);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+"""
+IMAGE_COLUMNS = "images.path, images.hash, images.is_video, images.size, images.ts, images.width, images.height, images.rotated_hashes, images.hdr, images.sample"
+PAGE_SIZE = 1000
+
+
+class SqliteStorage:
+    logger = logging.getLogger(__name__)
+    file_name = "images.sqlite"
+
+    def __init__(self, data_dir: Path, file_name: str = None):
+        self.path = Path(os.path.join(data_dir, file_name or self.file_name))
+        self.connection = sqlite3.connect(self.path.as_posix(), isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(images)")]
+        if "sample" not in columns:
+            self._write("ALTER TABLE images ADD COLUMN sample TEXT")
+        self._move_exif(columns)
+        if "nlink" in [row[1] for row in self.connection.execute("PRAGMA table_info(dir_fingerprints)")]:
+            # fingerprints stored with the link count of the directory instead of its entry count never match
+            self._write("DELETE FROM dir_fingerprints")
+            self._write("ALTER TABLE dir_fingerprints RENAME COLUMN nlink TO entries")
+            self.commit()
+
+    def _move_exif(self, columns: List[str]):
+        # Databases created before ImageInfo was slimmed have the exif in the images table
+        if "hdr" not in columns:
+            self._write("ALTER TABLE images ADD COLUMN hdr INTEGER")
+        if "exif" not in columns:
+            self.commit()
+            return
+        rows = self.connection.execute("SELECT path, exif FROM images WHERE exif IS NOT NULL").fetchall()
+        for path, exif in rows:
+            self._write("INSERT OR REPLACE INTO exif (path, exif) VALUES (?, ?)", (path, exif))
+            self._write("UPDATE images SET hdr = ? WHERE path = ?", (int(ImageInfo.is_hdr(json.loads(exif))), path))
+        self._write("UPDATE images SET exif = NULL")
+        self.commit()
+        if rows:
+            self.logger.info(f"Moved the exif of {len(rows)} images out of the images table")
+            self.connection.execute("VACUUM")
+
+    def _write(self, sql: str, params: Tuple = ()):
+        # writes are grouped in one transaction until the next commit
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+        return self.connection.execute(sql, params)
+
+    @classmethod
+    def _to_row(cls, image: ImageInfo) -> Tuple:
+        is_video = not isinstance(image.hash, ImageHash)
+        rotated_hashes = " ".join(str(rotated_hash) for rotated_hash in image.rotated_hashes) if image.rotated_hashes else None
+        return str(image.path), str(image.hash), int(is_video), image.size, image.ts.isoformat(), image.width, image.height, rotated_hashes, int(image.hdr), image.sample
+
+    @classmethod
+    def _to_image(cls, row: Tuple) -> ImageInfo:
+        path, image_hash, is_video, size, ts, width, height, rotated_hashes, hdr, sample = row
+        if not is_video:
+            image_hash = imagehash.hex_to_hash(image_hash)
+        if rotated_hashes:
+            rotated_hashes = [imagehash.hex_to_hash(rotated_hash) for rotated_hash in rotated_hashes.split()]
+        return ImageInfo(Path(path), size, image_hash, datetime.fromisoformat(ts), width, height, None, rotated_hashes or None, bool(hdr), sample)
+
+    def _get_image(self, sql: str, params: Tuple) -> Optional[ImageInfo]:
+        row = self.connection.execute(sql, params).fetchone()
+        return self._to_image(row) if row else None
+
+    @property
+    def generation(self) -> int:
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    @generation.setter
+    def generation(self, generation: int):
+        self._write("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (generation,))
+
+    def commit(self):
+        if self.connection.in_transaction:
+            self.connection.execute("COMMIT")
+
+    def close(self):
+        if self.connection.in_transaction:
+            self.connection.execute("ROLLBACK")
+        self.connection.close()
+
+    def get_by_path(self, key: str) -> ImageInfo:
+        return self._get_image(f"SELECT {IMAGE_COLUMNS} FROM images WHERE path = ?", (key,))
+
+    def get_by_hash(self, key: str) -> ImageInfo:
+        return self._get_image(f"SELECT {IMAGE_COLUMNS} FROM by_hash JOIN images ON images.path = by_hash.path WHERE by_hash.hash = ?", (key,))
+
+    def get_by_rotated_hash(self, key: str) -> ImageInfo:
+        return self._get_image(f"SELECT {IMAGE_COLUMNS} FROM by_rotated_hash JOIN images ON images.path = by_rotated_hash.path WHERE by_rotated_hash.hash = ?", (key,))
+
+    def put(self, image: ImageInfo):
+        path = str(image.path)
+        self._write("INSERT OR REPLACE INTO images (path, hash, is_video, size, ts, width, height, rotated_hashes, hdr, sample) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._to_row(image))
+        self._write("INSERT OR REPLACE INTO by_hash (hash, path) VALUES (?, ?)", (str(image.hash), path))
+        for rotated_hash in image.rotated_hashes or []:
+            self._write("INSERT OR REPLACE INTO by_rotated_hash (hash, path) VALUES (?, ?)", (str(rotated_hash), path))
+
+    def delete(self, image: ImageInfo):
+        path = str(image.path)
+        self._write("DELETE FROM images WHERE path = ?", (path,))
+        self._write("DELETE FROM exif WHERE path = ?", (path,))
+        # another record with the same hash keeps its entry
+        self._write("DELETE FROM by_hash WHERE path = ?", (path,))
+        self._write("DELETE FROM by_rotated_hash WHERE path = ?", (path,))
+
+    def get_by_size(self, size: int) -> List[ImageInfo]:
+        rows = self.connection.execute(f"SELECT {IMAGE_COLUMNS} FROM images WHERE size = ?", (size,)).fetchall()
+        return [self._to_image(row) for row in rows]
+
+    def get_videos_by_size(self, size: int) -> List[ImageInfo]:
+        rows = self.connection.execute(f"SELECT {IMAGE_COLUMNS} FROM images WHERE size = ? AND is_video = 1", (size,)).fetchall()
+        return [self._to_image(row) for row in rows]
+
+    def get_exif(self, key: str) -> Optional[Dict]:
+        row = self.connection.execute("SELECT exif FROM exif WHERE path = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_exif(self, key: str, exif: Dict):
+        self._write("INSERT OR REPLACE INTO exif (path, exif) VALUES (?, ?)", (key, json.dumps(exif, default=str)))
+
+    def all_exif(self) -> Iterator[Tuple[str, Dict]]:
+        for row in self.connection.execute("SELECT path, exif FROM exif").fetchall():
+            yield row[0], json.loads(row[1])
+
+    def get_file_hashes(self, key: str) -> Optional[Tuple]:
+        row = self.connection.execute("SELECT size, mtime_ns, digest, image_hash FROM file_hashes WHERE path = ?", (key,)).fetchone()
+        return tuple(row) if row else None
+
+    def set_file_hashes(self, key: str, file_hashes: Tuple):
+        self._write("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)", (key,) + tuple(file_hashes))
+
+    def delete_file_hashes(self, key: str) -> bool:
+        return self._write("DELETE FROM file_hashes WHERE path = ?", (key,)).rowcount > 0
+
+    def get_dir_fingerprint(self, key: str) -> Optional[Tuple]:
+        row = self.connection.execute("SELECT mtime_ns, ino, entries, subdirs FROM dir_fingerprints WHERE path = ?", (key,)).fetchone()
+        if row:
+            return row[0], row[1], row[2], tuple(json.loads(row[3]))
+
+    def set_dir_fingerprint(self, key: str, fingerprint: Tuple):
+        mtime_ns, ino, entries, subdirs = fingerprint
+        self._write("INSERT OR REPLACE INTO dir_fingerprints VALUES (?, ?, ?, ?, ?)", (key, mtime_ns, ino, entries, json.dumps(list(subdirs))))
+
+    def clear_dir_fingerprints(self):
+        self._write("DELETE FROM dir_fingerprints")
+
+    def all_file_hashes(self) -> Iterator[Tuple[str, Tuple]]:
+        for row in self.connection.execute("SELECT path, size, mtime_ns, digest, image_hash FROM file_hashes").fetchall():
+            yield row[0], tuple(row[1:])
+
+    def all_dir_fingerprints(self) -> Iterator[Tuple[str, Tuple]]:
+        for row in self.connection.execute("SELECT path FROM dir_fingerprints").fetchall():
+            yield row[0], self.get_dir_fingerprint(row[0])
+
+    def count_by_path(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def count_by_hash(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM by_hash").fetchone()[0]
+
+    def all_images(self) -> Iterator[ImageInfo]:
+        # paged by primary key so callers can modify the database while iterating
+        last_path = ""
+        while True:
+            rows = self.connection.execute(f"SELECT {IMAGE_COLUMNS} FROM images WHERE path > ? ORDER BY path LIMIT ?", (last_path, PAGE_SIZE)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._to_image(row)
+            last_path = rows[-1][0]
+
+    def all_paths(self) -> Iterator[str]:
+        return [row[0] for row in self.connection.execute("SELECT path FROM images ORDER BY path")]
+
+    def all_hashes(self) -> Iterator[str]:
+        return [row[0] for row in self.connection.execute("SELECT hash FROM by_hash ORDER BY hash")]
+
+    def migrate_from(self, storage):
+        self.logger.info(f"Migrating {storage.path} to {self.path}")
+        for image in storage.all_images():
+            self.put(image)
+        for key in storage.all_hashes():
+            image = storage.get_by_hash(key)
+            self._write("INSERT OR REPLACE INTO by_hash (hash, path) VALUES (?, ?)", (key, str(image.path)))
+        for key, exif in storage.all_exif():
+            self.set_exif(key, exif)
+        for key, file_hashes in storage.all_file_hashes():
+            self.set_file_hashes(key, file_hashes)
+        for key, fingerprint in storage.all_dir_fingerprints():
+            self.set_dir_fingerprint(key, fingerprint)
+        self.generation = storage.generation
+        self.commit()
+        self.logger.info(f"Migrated {self.count_by_path()} images")
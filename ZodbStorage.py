@@ -0,0 +1,191 @@
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import transaction
+from BTrees import OOBTree
+from ZODB import DB
+from ZODB.FileStorage import FileStorage
+from imagehash import ImageHash
+
+from ImageInfo import ImageInfo
+
+MIGRATION_COMMIT_SIZE = 10000
+
+
+class ZodbStorage:
+    logger = logging.getLogger(__name__)
+    file_name = "images.db"
+
+    def __init__(self, data_dir: Path):
+        self.path = Path(os.path.join(data_dir, self.file_name))
+        self.storage = FileStorage(self.path.as_posix())
+        self.db = DB(self.storage)
+        # a transaction manager of its own, so another open database is not committed or aborted with this one
+        self.transaction_manager = transaction.TransactionManager()
+        self.connection = self.db.open(self.transaction_manager)
+        self.root = self.connection.root
+        # checked on the root rather than the file, a crash before the first commit leaves an empty file
+        if not hasattr(self.root, "by_path"):
+            self.root.by_path = OOBTree.BTree()
+            self.root.by_hash = OOBTree.BTree()
+        if not hasattr(self.root, "generation"):
+            self.root.generation = 0
+        if not hasattr(self.root, "dir_fingerprints"):
+            self.root.dir_fingerprints = OOBTree.BTree()
+        if not hasattr(self.root, "by_rotated_hash"):
+            self.root.by_rotated_hash = OOBTree.BTree()
+        if not hasattr(self.root, "file_hashes"):
+            self.root.file_hashes = OOBTree.BTree()
+        if not hasattr(self.root, "paths_by_size"):
+            # replaces the index of the videos only, byte-identical images are found by size too
+            self.root.paths_by_size = self._build_paths_by_size()
+            if hasattr(self.root, "videos_by_size"):
+                del self.root.videos_by_size
+        if not hasattr(self.root, "exif_by_path"):
+            self.root.exif_by_path = OOBTree.BTree()
+            self._move_exif()
+
+    def _move_exif(self):
+        # Records stored before ImageInfo was slimmed carry the full exif, it goes to exif_by_path
+        # and every record is written again in the compact format
+        count = 0
+        for image in self.root.by_path.values():
+            if image.exif is not None:
+                self.root.exif_by_path[str(image.path)] = image.exif
+                image.exif = None
+            image._p_changed = True
+            count += 1
+            if count % MIGRATION_COMMIT_SIZE == 0:
+                self.commit()
+                self.connection.cacheGC()
+        if count:
+            self.commit()
+            self.logger.info(f"Moved the exif of {count} images out of their records")
+            # drops the old revisions, FileStorage only appends
+            self.db.pack()
+
+    def _build_paths_by_size(self) -> OOBTree.BTree:
+        paths_by_size = OOBTree.BTree()
+        for image in self.all_images():
+            paths_by_size[image.size] = paths_by_size.get(image.size, ()) + (str(image.path),)
+        return paths_by_size
+
+    @property
+    def generation(self) -> int:
+        return self.root.generation
+
+    @generation.setter
+    def generation(self, generation: int):
+        self.root.generation = generation
+
+    def commit(self):
+        self.transaction_manager.commit()
+
+    def close(self):
+        self.transaction_manager.abort()
+        self.connection.close()
+        self.db.close()
+
+    def get_by_path(self, key: str) -> ImageInfo:
+        return self.root.by_path.get(key)
+
+    def get_by_hash(self, key: str) -> ImageInfo:
+        return self.root.by_hash.get(key)
+
+    def get_by_rotated_hash(self, key: str) -> ImageInfo:
+        return self.root.by_rotated_hash.get(key)
+
+    def put(self, image: ImageInfo):
+        self.root.by_path[str(image.path)] = image
+        self.root.by_hash[str(image.hash)] = image
+        for rotated_hash in image.rotated_hashes or []:
+            self.root.by_rotated_hash[str(rotated_hash)] = image
+        paths = self.root.paths_by_size.get(image.size, ())
+        if str(image.path) not in paths:
+            self.root.paths_by_size[image.size] = paths + (str(image.path),)
+
+    def delete(self, image: ImageInfo):
+        try:
+            del self.root.by_path[str(image.path)]
+        except KeyError:
+            pass
+        # another record with the same hash keeps its entry
+        if self._is_entry_of(self.root.by_hash, str(image.hash), image):
+            del self.root.by_hash[str(image.hash)]
+        for rotated_hash in image.rotated_hashes or []:
+            if self._is_entry_of(self.root.by_rotated_hash, str(rotated_hash), image):
+                del self.root.by_rotated_hash[str(rotated_hash)]
+        try:
+            del self.root.exif_by_path[str(image.path)]
+        except KeyError:
+            pass
+        paths = tuple(p for p in self.root.paths_by_size.get(image.size, ()) if p != str(image.path))
+        if paths:
+            self.root.paths_by_size[image.size] = paths
+        elif image.size in self.root.paths_by_size:
+            del self.root.paths_by_size[image.size]
+
+    def get_by_size(self, size: int) -> List[ImageInfo]:
+        images = [self.root.by_path.get(path) for path in self.root.paths_by_size.get(size, ())]
+        return [image for image in images if image]
+
+    @classmethod
+    def _is_entry_of(cls, tree: OOBTree.BTree, key: str, image: ImageInfo) -> bool:
+        entry = tree.get(key)
+        return entry is not None and str(entry.path) == str(image.path)
+
+    def get_videos_by_size(self, size: int) -> List[ImageInfo]:
+        return [image for image in self.get_by_size(size) if not isinstance(image.hash, ImageHash)]
+
+    def get_exif(self, key: str) -> Optional[Dict]:
+        return self.root.exif_by_path.get(key)
+
+    def set_exif(self, key: str, exif: Dict):
+        self.root.exif_by_path[key] = exif
+
+    def all_exif(self) -> Iterator[Tuple[str, Dict]]:
+        return self.root.exif_by_path.items()
+
+    def get_file_hashes(self, key: str) -> Optional[Tuple]:
+        return self.root.file_hashes.get(key)
+
+    def set_file_hashes(self, key: str, file_hashes: Tuple):
+        self.root.file_hashes[key] = file_hashes
+
+    def delete_file_hashes(self, key: str) -> bool:
+        if key in self.root.file_hashes:
+            del self.root.file_hashes[key]
+            return True
+        return False
+
+    def get_dir_fingerprint(self, key: str) -> Optional[Tuple]:
+        return self.root.dir_fingerprints.get(key)
+
+    def set_dir_fingerprint(self, key: str, fingerprint: Tuple):
+        self.root.dir_fingerprints[key] = fingerprint
+
+    def clear_dir_fingerprints(self):
+        self.root.dir_fingerprints.clear()
+
+    def all_file_hashes(self) -> Iterator[Tuple[str, Tuple]]:
+        return self.root.file_hashes.items()
+
+    def all_dir_fingerprints(self) -> Iterator[Tuple[str, Tuple]]:
+        return self.root.dir_fingerprints.items()
+
+    def count_by_path(self) -> int:
+        return len(self.root.by_path)
+
+    def count_by_hash(self) -> int:
+        return len(self.root.by_hash)
+
+    def all_images(self) -> Iterator[ImageInfo]:
+        return self.root.by_path.values()
+
+    def all_paths(self) -> Iterator[str]:
+        return self.root.by_path.keys()
+
+    def all_hashes(self) -> Iterator[str]:
+        return self.root.by_hash.keys()
@@ -0,0 +1,48 @@
+import argparse
+import json
+from logging.config import fileConfig
+
+fileConfig("logger.ini")
+
+args_parser = argparse.ArgumentParser(description='Find near duplicate images already in a sorted library, and remove them with --apply')
+args_parser.add_argument('destination', type=str, help='Full path to the sorted directory')
+args_parser.add_argument('--max-dist', type=int, help='Largest hash distance of near duplicates (default: SIMILAR_IMAGE_HASH_DIST)')
+args_parser.add_argument('--apply', action='store_true', help='Keep the best image of each cluster and recycle the others, the default only reports them')
+args_parser.add_argument('--report', type=str, help='Also write the clusters found to this JSON file')
+args_parser.add_argument('--hash-index', choices=['bktree', 'matrix'], default='bktree', help='Index used to find similar images (default: bktree)')
+args_parser.add_argument('--check', choices=['fast', 'incremental', 'full'], default='incremental', help='Database verification on startup (default: incremental)')
+
+if __name__ == "__main__":
+    args = args_parser.parse_args()
+
+    from pathlib import Path
+    from ImageDatabase import ImageDatabase
+    from ImageSorter import ImageSorter, SIMILAR_IMAGE_HASH_DIST
+
+    destination = Path(args.destination)
+    if not ImageDatabase.exists(destination):
+        print(f"{destination} has no image database")
+        exit(1)
+    max_dist = SIMILAR_IMAGE_HASH_DIST if args.max_dist is None else args.max_dist
+    image_sorter = ImageSorter(destination, hash_index=args.hash_index, check=args.check, backend=ImageDatabase.find_backend(destination))
+    try:
+        report = image_sorter.audit_library(max_dist)
+        for cluster in report:
+            print(f"Keep {cluster['keep']} ({cluster['width']}x{cluster['height']}, {cluster['size']} bytes, {cluster['ts']})")
+            for removed in cluster["remove"]:
+                print(f"  remove {removed['path']} ({removed['width']}x{removed['height']}, {removed['size']} bytes, {removed['ts']}), distance {removed['distance']}")
+            for path in cluster["not_similar_to_kept"]:
+                print(f"  keep {path}, only similar to the images removed")
+        removed_count = sum(len(cluster["remove"]) for cluster in report)
+        removed_size = sum(removed["size"] for cluster in report for removed in cluster["remove"])
+        print(f"Clusters: {len(report)}, images to remove: {removed_count} ({removed_size / 1e6:.1f} MB), max distance {max_dist}")
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump({"max_dist": max_dist, "clusters": report}, f, indent=2)
+        if args.apply:
+            image_sorter.apply_audit(report)
+            print(f"Removed {removed_count} images, they are in {image_sorter.recycle_dir} unless identical to the image kept")
+        elif report:
+            print("Dry run, use --apply to remove them")
+    finally:
+        image_sorter.close()
@@ -0,0 +1,300 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+args_parser = argparse.ArgumentParser(description='Benchmark loading, similarity lookups, database verification and commits on a generated corpus')
+args_parser.add_argument('--sizes', type=int, nargs='+', default=[1000], help='Corpus sizes to benchmark, e.g. 1000 10000 100000 (default: 1000)')
+args_parser.add_argument('--stages', nargs='+', choices=['load', 'sort', 'lookup', 'check', 'commit'], default=['load', 'sort', 'lookup', 'check', 'commit'], help='Stages to run (default: all)')
+args_parser.add_argument('--work-dir', type=str, default=os.path.join(tempfile.gettempdir(), 'imagesort-benchmark'), help='Where corpora and libraries are created, corpora are reused between runs')
+args_parser.add_argument('--seed', type=int, default=1, help='Seed of the generated corpus (default: 1)')
+args_parser.add_argument('--db-backend', choices=['zodb', 'sqlite'], default='zodb', help='Database used for the sort, check and commit stages (default: zodb)')
+args_parser.add_argument('--hash-index', choices=['bktree', 'matrix'], default='bktree', help='Index used by the sort and check stages, the lookup stage measures both (default: bktree)')
+args_parser.add_argument('--workers', type=int, default=1, help='Number of processes used to load files in the sort stage (default: 1)')
+args_parser.add_argument('--fast-hash', action='store_true', help='Hash images from a reduced resolution decode')
+args_parser.add_argument('--queries', type=int, default=1000, help='Number of similarity lookups (default: 1000)')
+args_parser.add_argument('--output', type=str, help='Write the results to this JSON file instead of stdout')
+args_parser.add_argument('--compare', type=str, help='Print the change of every timing against a previous JSON result')
+
+IMAGE_SIZE = (320, 240)
+FILES_PER_DIR = 500
+BASE_TS = datetime(2015, 1, 1)
+
+
+def generate_image(rand: random.Random):
+    from PIL import Image, ImageDraw
+    image = Image.new("RGB", IMAGE_SIZE, tuple(rand.randint(0, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rand.randint(0, IMAGE_SIZE[0] - 20), rand.randint(0, IMAGE_SIZE[1] - 20)
+        draw.rectangle([x, y, x + rand.randint(10, 160), y + rand.randint(10, 120)], fill=tuple(rand.randint(0, 255) for _ in range(3)))
+    return image
+
+
+def generate_corpus(corpus_dir: Path, count: int, seed: int) -> Dict:
+    # Same seed and count give the same files. Roughly 70% originals, 20% near duplicates
+    # (resized, rotated or recompressed), 5% PNG and 5% videos of which a third are exact copies.
+    import piexif
+    marker = Path(os.path.join(corpus_dir, ".complete"))
+    if marker.exists():
+        return json.loads(marker.read_text())
+    if corpus_dir.exists():
+        shutil.rmtree(corpus_dir)
+    rand = random.Random(seed)
+    counts = {"jpg": 0, "png": 0, "near_duplicate": 0, "video": 0, "video_copy": 0}
+    originals = []
+    videos = []
+    for i in range(count):
+        file_dir = Path(os.path.join(corpus_dir, f"{i // FILES_PER_DIR:04d}"))
+        file_dir.mkdir(parents=True, exist_ok=True)
+        ts = BASE_TS + timedelta(seconds=rand.randint(0, 5 * 365 * 24 * 3600))
+        exif = piexif.dump({"Exif": {piexif.ExifIFD.DateTimeOriginal: ts.strftime("%Y:%m:%d %H:%M:%S").encode()}})
+        kind = rand.random()
+        if kind < 0.05:
+            path = Path(os.path.join(file_dir, f"clip{i}.mov"))
+            if videos and rand.random() < 0.33:
+                shutil.copyfile(rand.choice(videos), path)
+                counts["video_copy"] += 1
+            else:
+                size = rand.randint(100, 500) * 1024
+                path.write_bytes(rand.getrandbits(size * 8).to_bytes(size, "little"))
+                videos.append(path)
+                counts["video"] += 1
+        elif kind < 0.25 and originals:
+            image, exif = rand.choice(originals)
+            variant = rand.randrange(3)
+            if variant == 0:
+                image = image.resize((IMAGE_SIZE[0] // 2, IMAGE_SIZE[1] // 2))
+            elif variant == 1:
+                image = image.rotate(rand.choice((90, 180, 270)), expand=True)
+            image.save(os.path.join(file_dir, f"dup{i}.jpg"), exif=exif, quality=rand.randint(60, 90))
+            counts["near_duplicate"] += 1
+        elif kind < 0.30:
+            generate_image(rand).save(os.path.join(file_dir, f"img{i}.png"))
+            counts["png"] += 1
+        else:
+            image = generate_image(rand)
+            image.save(os.path.join(file_dir, f"img{i}.jpg"), exif=exif, quality=95)
+            if len(originals) < 1000:
+                originals.append((image, exif))
+            else:
+                originals[rand.randrange(len(originals))] = (image, exif)
+            counts["jpg"] += 1
+    info = {"files": count, "bytes": sum(path.stat().st_size for path in corpus_files(corpus_dir)), "seed": seed, "composition": counts}
+    marker.write_text(json.dumps(info))
+    return info
+
+
+def corpus_files(corpus_dir: Path) -> List[Path]:
+    files = []
+    for dir_path, dir_names, file_names in os.walk(corpus_dir):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith("."))
+        files.extend(Path(os.path.join(dir_path, name)) for name in sorted(file_names) if not name.startswith("."))
+    return files
+
+
+def copy_tree(src_dir: Path, dst_dir: Path):
+    # sorting moves the incoming files away and rewrites exif in place, so it works on a copy of the corpus
+    for path in corpus_files(src_dir):
+        new_path = Path(os.path.join(dst_dir, path.relative_to(src_dir)))
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(path, new_path)
+
+
+def peak_rss_kb() -> Dict:
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def latency_summary(latencies: List[float]) -> Dict:
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def bench_load(files: List[Path]) -> Dict:
+    from ImageLoader import ImageLoader
+    size = sum(path.stat().st_size for path in files)
+    start = time.monotonic()
+    loaded = 0
+    for i in range(0, len(files), ImageLoader.exif_batch_size):
+        loaded += len(ImageLoader.load_batch(files[i:i + ImageLoader.exif_batch_size]))
+    seconds = time.monotonic() - start
+    ImageLoader.terminate()
+    return {"seconds": seconds, "files": loaded, "files_per_s": loaded / seconds, "mb_per_s": size / seconds / 1e6}
+
+
+def bench_sort(corpus_dir: Path, library_dir: Path, args) -> Dict:
+    from ImageSorter import ImageSorter
+    incoming_dir = Path(os.path.join(library_dir.parent, "incoming"))
+    for path in (library_dir, incoming_dir):
+        if path.exists():
+            shutil.rmtree(path)
+    library_dir.mkdir(parents=True)
+    copy_tree(corpus_dir, incoming_dir)
+    start = time.monotonic()
+    image_sorter = ImageSorter(library_dir, hash_index=args.hash_index, workers=args.workers, check="fast", backend=args.db_backend)
+    try:
+        image_sorter.sort_dir(incoming_dir)
+    finally:
+        image_sorter.close()
+    seconds = time.monotonic() - start
+    shutil.rmtree(incoming_dir, ignore_errors=True)
+    files = len(corpus_files(corpus_dir))
+    return {"seconds": seconds, "files_per_s": files / seconds}
+
+
+def bench_lookup(library_dir: Path, args) -> Dict:
+    # Queries are stored hashes with a few bits flipped, half of them within SIMILAR_IMAGE_HASH_DIST
+    from imagehash import ImageHash
+    from HashIndex import HashIndex
+    from HashMatrix import HashMatrix
+    from ImageDatabase import ImageDatabase
+    from ImageSorter import SIMILAR_IMAGE_HASH_DIST
+    db = ImageDatabase(library_dir, backend=args.db_backend)
+    hashes = [image.hash for image in db.all_images() if isinstance(image.hash, ImageHash)]
+    db.close()
+    if not hashes:
+        return {}
+    rand = random.Random(args.seed)
+    query_hashes = []
+    for _ in range(args.queries):
+        bits = rand.choice(hashes).hash.copy()
+        for _ in range(rand.choice((1, SIMILAR_IMAGE_HASH_DIST, 8, 20))):
+            bits.flat[rand.randrange(bits.size)] ^= True
+        query_hashes.append(ImageHash(bits))
+    results = {"hashes": len(hashes)}
+    with tempfile.TemporaryDirectory() as index_dir:
+        for name, index in (("bktree", HashIndex(Path(index_dir))), ("matrix", HashMatrix(Path(index_dir)))):
+            start = time.monotonic()
+            for image_hash in hashes:
+                index.add(image_hash)
+            build_seconds = time.monotonic() - start
+            latencies = []
+            found = 0
+            for image_hash in query_hashes:
+                start = time.monotonic()
+                found += index.find(image_hash, SIMILAR_IMAGE_HASH_DIST) is not None
+                latencies.append(time.monotonic() - start)
+            start = time.monotonic()
+            index.find_many(query_hashes, SIMILAR_IMAGE_HASH_DIST)
+            batch_seconds = time.monotonic() - start
+            results[name] = dict(latency_summary(latencies), build_seconds=build_seconds, found=found, find_many_ms=batch_seconds * 1000)
+    return results
+
+
+def bench_check(library_dir: Path, args) -> Dict:
+    from ImageSorter import ImageSorter
+    results = {}
+    for mode in ("full", "incremental", "fast"):
+        start = time.monotonic()
+        image_sorter = ImageSorter(library_dir, hash_index=args.hash_index, check=mode, backend=args.db_backend)
+        results[f"{mode}_seconds"] = time.monotonic() - start
+        image_sorter.close()
+    return results
+
+
+def bench_commit(count: int, args) -> Dict:
+    # Synthetic records, so the cost measured is only the database and the hash index sidecars
+    import numpy
+    from imagehash import ImageHash
+    from ImageDatabase import ImageDatabase
+    from ImageInfo import ImageInfo
+    rand = numpy.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as library_dir:
+        db = ImageDatabase(Path(library_dir), save_threshold=count + 1, hash_index=args.hash_index, backend=args.db_backend)
+        latencies = []
+        batch_size = max(1, count // 100)
+        start = time.monotonic()
+        for i in range(count):
+            image_hash = ImageHash(rand.integers(0, 2, (10, 10), dtype=numpy.uint8).astype(bool))
+            db.add(ImageInfo(Path(os.path.join(library_dir, f"{i}.jpg")), 100000, image_hash, BASE_TS + timedelta(seconds=i), 320, 240, {}))
+            if (i + 1) % batch_size == 0:
+                commit_start = time.monotonic()
+                db.save()
+                latencies.append(time.monotonic() - commit_start)
+        seconds = time.monotonic() - start
+        db.close()
+        size = sum(path.stat().st_size for path in Path(library_dir).rglob("*") if path.is_file())
+    return dict(latency_summary(latencies), records_per_commit=batch_size, seconds=seconds, records_per_s=count / seconds, db_bytes=size)
+
+
+def compare(results: Dict, previous: Dict):
+    def timings(result, prefix=""):
+        for key, value in result.items():
+            if isinstance(value, dict):
+                yield from timings(value, f"{prefix}{key}.")
+            elif isinstance(value, (int, float)) and (key.endswith("seconds") or key.endswith("_ms")):
+                yield f"{prefix}{key}", value
+    previous_runs = {run["files"]: dict(timings(run["stages"])) for run in previous["runs"]}
+    for run in results["runs"]:
+        before = previous_runs.get(run["files"], {})
+        for key, value in timings(run["stages"]):
+            if before.get(key):
+                print(f"{run['files']:>7} {key:<40} {before[key]:>10.3f} -> {value:>10.3f} ({(value / before[key] - 1) * 100:+.1f}%)")
+
+
+if __name__ == "__main__":
+    args = args_parser.parse_args()
+    # per file INFO logging would be measured too
+    logging.basicConfig(level=logging.WARNING)
+
+    from ImageLoader import ImageLoader
+    ImageLoader.fast_hash = args.fast_hash
+
+    results = {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "runs": [],
+    }
+    for count in args.sizes:
+        corpus_dir = Path(os.path.join(args.work_dir, f"corpus-{count}-{args.seed}"))
+        library_dir = Path(os.path.join(args.work_dir, f"library-{count}-{args.seed}", "sorted"))
+        start = time.monotonic()
+        corpus = generate_corpus(corpus_dir, count, args.seed)
+        print(f"Corpus of {count} files ready in {time.monotonic() - start:.1f}s")
+        run = {"files": count, "corpus": corpus, "stages": {}}
+        stages = run["stages"]
+        if "load" in args.stages:
+            stages["load"] = bench_load(corpus_files(corpus_dir))
+        if "sort" in args.stages or ("lookup" in args.stages or "check" in args.stages) and not library_dir.exists():
+            stages["sort"] = bench_sort(corpus_dir, library_dir, args)
+        if "lookup" in args.stages:
+            stages["lookup"] = bench_lookup(library_dir, args)
+        if "check" in args.stages:
+            stages["check"] = bench_check(library_dir, args)
+        if "commit" in args.stages:
+            stages["commit"] = bench_commit(count, args)
+        # ru_maxrss only grows, so each size is run after the smaller ones have set a lower bound
+        run["peak_rss_kb"] = peak_rss_kb()
+        results["runs"].append(run)
+        print(f"Finished {count} files: " + ", ".join(stages))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+    else:
+        print(json.dumps(results, indent=2, default=str))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -6,16 +6,68 @@ fileConfig("logger.ini")
 args_parser = argparse.ArgumentParser(description='Sort images and videos by oldest timestamp')
 args_parser.add_argument('destination', type=str, help='Full path to destination directory')
 args_parser.add_argument('source', type=str, nargs='+', help='Input directory(s) to process')
+args_parser.add_argument('--db-backend', choices=['zodb', 'sqlite'], help='Database used to store image info, an existing ZODB database is migrated the first time sqlite is used (default: the database found in the destination, zodb for a new one)')
+args_parser.add_argument('--hash-index', choices=['bktree', 'matrix'], default='bktree', help='Index used to find similar images (default: bktree)')
+args_parser.add_argument('--workers', type=int, default=1, help='Number of processes used to load and hash files (default: 1)')
+args_parser.add_argument('--move-threads', type=int, default=4, help='Number of threads used to move files, 1 moves them inline (default: 4)')
+args_parser.add_argument('--check', choices=['fast', 'incremental', 'full'], default='incremental', help='Database verification on startup: skip it, only rescan changed directories, or verify everything (default: incremental)')
+args_parser.add_argument('--fast-hash', action='store_true', help='Hash images from a reduced resolution decode, see validate_hash.py')
+args_parser.add_argument('--exiftool-procs', type=int, default=1, help='Number of ExifTool processes per loading process (default: 1)')
+args_parser.add_argument('--merge', action='store_true', help='The sources are sorted libraries, use the image info in their databases instead of loading every file again')
+args_parser.add_argument('--watch', action='store_true', help='After sorting the sources, keep running and sort new files as they arrive in them')
+args_parser.add_argument('--poll', action='store_true', help='With --watch, scan the sources every second instead of using inotify')
+args_parser.add_argument('--progress', action='store_true', help='Show files/s and MB/s on a progress bar, the console only logs warnings and errors')
+args_parser.add_argument('--stats', type=str, help='Write per stage counters and timings at the end of the run, in the Prometheus textfile format if the name ends with .prom, JSON otherwise')
+args_parser.add_argument('--profile', type=str, help='Profile the run with cProfile and write the result to this file (read it with python -m pstats)')
+args_parser.add_argument('--load-cache-mb', type=int, default=256, help='Size of the cache of loaded source files kept in the destination, an interrupted import does not load them again. 0 disables it (default: 256)')
+args_parser.add_argument('--exiftool-batch', type=int, default=50, help='Number of files read per ExifTool call (default: 50)')
 
 if __name__ == "__main__":
     args = args_parser.parse_args()
 
+    import logging
+    import signal
+    import sys
     from pathlib import Path
+    from ImageDatabase import ImageDatabase
+    from ImageLoader import ImageLoader
     from ImageSorter import ImageSorter
+    from RunStats import stats
 
+    if args.progress:
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler) and getattr(handler, "stream", None) is sys.stdout:
+                handler.setLevel(logging.WARNING)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    ImageLoader.exif_processes = args.exiftool_procs
+    ImageLoader.exif_batch_size = args.exiftool_batch
+    ImageLoader.fast_hash = args.fast_hash
+    image_sorter = None
     try:
-        image_sorter = ImageSorter(Path(args.destination))
+        image_sorter = ImageSorter(Path(args.destination), hash_index=args.hash_index, workers=args.workers, check=args.check, backend=args.db_backend or ImageDatabase.find_backend(Path(args.destination)), move_threads=args.move_threads, progress=args.progress, load_cache_bytes=args.load_cache_mb * 1024 * 1024)
         for source_path_str in args.source:
-            image_sorter.sort_dir(Path(source_path_str))
+            if args.merge:
+                image_sorter.merge_library(Path(source_path_str))
+            else:
+                image_sorter.sort_dir(Path(source_path_str))
+        if args.watch:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            image_sorter.watch([Path(source_path_str) for source_path_str in args.source], use_inotify=not args.poll)
+    except KeyboardInterrupt:
+        ImageSorter.logger.info("Interrupted")
     except Exception as e:
         ImageSorter.logger.exception(f"Sort failed: {str(e)}")
+    finally:
+        if image_sorter:
+            image_sorter.close()
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        stats.log_summary()
+        if args.stats:
+            stats.write(args.stats)
@@ -0,0 +1,29 @@
+import os
+import shutil
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import piexif
+import pytest
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+requires_exiftool = pytest.mark.skipif(shutil.which("exiftool") is None, reason="exiftool is not installed")
+
+
+def make_jpegs(dir_path: Path, count: int):
+    dir_path.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        image = Image.new("RGB", (320, 240), (i * 7 % 256, 40, 90))
+        draw = ImageDraw.Draw(image)
+        for j in range(6):
+            x, y = (i * 37 + j * 53) % 280, (i * 23 + j * 41) % 200
+            draw.rectangle([x, y, x + 20 + j * 5, y + 15 + i % 30], fill=((i * 13 + j * 50) % 256, (j * 70) % 256, (i * 31) % 256))
+        taken = (datetime(2019, 1, 1) + timedelta(days=i, seconds=i)).strftime("%Y:%m:%d %H:%M:%S").encode()
+        path = dir_path / f"img{i}.jpg"
+        image.save(path, exif=piexif.dump({"Exif": {piexif.ExifIFD.DateTimeOriginal: taken}}), quality=90)
+        paths.append(path)
+    return paths
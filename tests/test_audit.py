@@ -0,0 +1,35 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from conftest import make_jpegs, requires_exiftool
+from ImageSorter import ImageSorter
+
+
+@requires_exiftool
+@pytest.mark.parametrize("backend", ["zodb", "sqlite"])
+def test_audit_deletes_identical_copy(tmp_path: Path, backend: str):
+    sorted_dir = tmp_path / "sorted"
+    sorted_dir.mkdir()
+    make_jpegs(tmp_path / "incoming", 3)
+    image_sorter = ImageSorter(sorted_dir, backend=backend, load_cache_bytes=0)
+    try:
+        image_sorter.sort_dir(tmp_path / "incoming")
+        image = next(iter(image_sorter.db.all_images()))
+        # a copy stored after the original, so the shared by_hash entry is the copy's
+        copy_path = image.path.parent / f"zz-{image.path.name}"
+        shutil.copy2(image.path, copy_path)
+        image_sorter.db.add(image_sorter.copy_image(image, None, copy_path))
+
+        report = image_sorter.audit_library()
+        assert [(cluster["keep"], [removed["path"] for removed in cluster["remove"]]) for cluster in report] == [(str(image.path), [str(copy_path)])]
+        image_sorter.apply_audit(report)
+
+        assert not copy_path.exists()
+        assert not list((sorted_dir / ".imagesort" / "trash").rglob("*.jpg"))
+        assert image_sorter.db.get_by_hash(image.hash).path == image.path
+        assert image_sorter.db.hash_index.find(image.hash, 0) == str(image.hash)
+        assert image_sorter.db.count_by_path() == image_sorter.db.count_by_hash() == 3
+    finally:
+        image_sorter.close()
@@ -0,0 +1,26 @@
+import os
+from pathlib import Path
+
+import FileMover
+from FileMover import FileMover as Mover
+
+
+def test_short_copy_file_range_falls_back(tmp_path: Path, monkeypatch):
+    src = tmp_path / "a.jpg"
+    src.write_bytes(os.urandom(300_000))
+    data = src.read_bytes()
+    dst = tmp_path / "sorted" / "b.jpg"
+    dst.parent.mkdir()
+    copy_file_range = os.copy_file_range
+    calls = []
+
+    def stops_early(src_fd, dst_fd, count, offset_src, offset_dst):
+        calls.append(count)
+        return copy_file_range(src_fd, dst_fd, count, offset_src, offset_dst) if len(calls) == 1 else 0
+
+    monkeypatch.setattr(FileMover, "COPY_CHUNK_SIZE", 100_000)
+    monkeypatch.setattr(os, "copy_file_range", stops_early)
+    Mover._move_across_devices(src, dst)
+    assert len(calls) == 2
+    assert dst.read_bytes() == data
+    assert not src.exists()
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from conftest import make_jpegs, requires_exiftool
+from ImageSorter import ImageSorter
+
+# Sorts the incoming directory with a commit allowed after every modification, and kills the process
+# once the first move is done but before its record is added
+CRASH_SCRIPT = """
+import os
+import sys
+from pathlib import Path
+from ImageSorter import ImageSorter, FILE_DIGEST
+
+image_sorter = ImageSorter(Path(sys.argv[1]), check="fast", load_cache_bytes=0)
+image_sorter.db.save_seconds = 0
+incoming_dir = Path(sys.argv[2])
+for path in incoming_dir.iterdir():
+    # cached digests are moved with the file, a modification between the move and the add
+    image_sorter.file_hash(path, FILE_DIGEST)
+
+def crash(image):
+    image_sorter.mover.flush()
+    os._exit(3)
+
+image_sorter.db.add = crash
+image_sorter.sort_dir(incoming_dir)
+"""
+
+
+@requires_exiftool
+def test_replay_move_without_record(tmp_path: Path):
+    sorted_dir = tmp_path / "sorted"
+    sorted_dir.mkdir()
+    paths = make_jpegs(tmp_path / "images", 2)
+    (tmp_path / "incoming").mkdir()
+    os.rename(paths[1], tmp_path / "incoming" / paths[1].name)
+    image_sorter = ImageSorter(sorted_dir, load_cache_bytes=0)
+    try:
+        image_sorter.sort_dir(tmp_path / "images")
+    finally:
+        image_sorter.close()
+
+    result = subprocess.run([sys.executable, "-c", CRASH_SCRIPT, str(sorted_dir), str(tmp_path / "incoming")], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 3
+    assert not any((tmp_path / "incoming").iterdir())
+
+    image_sorter = ImageSorter(sorted_dir, check="fast", load_cache_bytes=0)
+    try:
+        images = list(image_sorter.db.all_images())
+        assert len(images) == 2
+        for image in images:
+            assert image.path.exists()
+        assert len(image_sorter.db.journal) == 0
+    finally:
+        image_sorter.close()
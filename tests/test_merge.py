@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import pytest
+
+from conftest import make_jpegs, requires_exiftool
+from ImageDatabase import ImageDatabase
+from ImageLoader import ImageLoader
+from ImageSorter import ImageSorter
+
+
+@requires_exiftool
+def test_merge_keeps_file_digests(tmp_path: Path):
+    library_dir = tmp_path / "library"
+    library_dir.mkdir()
+    make_jpegs(tmp_path / "incoming", 5)
+    image_sorter = ImageSorter(library_dir, load_cache_bytes=0)
+    try:
+        image_sorter.sort_dir(tmp_path / "incoming")
+    finally:
+        image_sorter.close()
+    library_db = ImageDatabase(library_dir)
+    digests = {}
+    for image in library_db.all_images():
+        stat = image.path.stat()
+        digests[image.path.name] = ImageLoader.digest_file(image.path.as_posix())
+        library_db.set_file_hashes(image.path, (stat.st_size, stat.st_mtime_ns, digests[image.path.name], None))
+    library_db.close()
+
+    sorted_dir = tmp_path / "sorted"
+    sorted_dir.mkdir()
+    image_sorter = ImageSorter(sorted_dir, load_cache_bytes=0)
+    try:
+        image_sorter.merge_library(library_dir)
+        images = list(image_sorter.db.all_images())
+        assert len(images) == 5
+        for image in images:
+            assert image_sorter.db.get_file_hashes(image.path)[2] == digests[image.path.name]
+    finally:
+        image_sorter.close()
+
+
+@requires_exiftool
+def test_merge_only_reads_library_database(tmp_path: Path):
+    library_dir = tmp_path / "library"
+    library_dir.mkdir()
+    make_jpegs(tmp_path / "incoming", 3)
+    image_sorter = ImageSorter(library_dir, load_cache_bytes=0)
+    try:
+        image_sorter.sort_dir(tmp_path / "incoming")
+    finally:
+        image_sorter.close()
+    for index_path in (library_dir / ".imagesort").glob("*.pickle"):
+        index_path.unlink()
+    journal_path = library_dir / ".imagesort" / "journal"
+    journal_path.write_text('["move", "/nowhere/a.jpg", "/nowhere/b.jpg"]\n')
+
+    sorted_dir = tmp_path / "sorted"
+    sorted_dir.mkdir()
+    image_sorter = ImageSorter(sorted_dir, load_cache_bytes=0)
+    try:
+        with pytest.raises(ValueError):
+            image_sorter.merge_library(library_dir)
+        journal_path.write_text("")
+        image_sorter.merge_library(library_dir)
+        assert len(list(image_sorter.db.all_images())) == 3
+    finally:
+        image_sorter.close()
+    assert not list((library_dir / ".imagesort").glob("*.pickle"))
@@ -0,0 +1,45 @@
+from datetime import datetime
+from pathlib import Path
+
+import imagehash
+import pytest
+
+from ImageDatabase import ImageDatabase
+from ImageInfo import ImageInfo
+from SqliteStorage import SqliteStorage
+
+
+def make_zodb_library(library_dir: Path, count: int):
+    db = ImageDatabase(library_dir, backend="zodb")
+    for i in range(count):
+        image_hash = imagehash.hex_to_hash(f"{i:016x}")
+        db.add(ImageInfo(library_dir / f"img{i}.jpg", 1000 + i, image_hash, datetime(2019, 1, 1 + i), 320, 240, {"EXIF:Make": "test"}, hdr=False))
+    db.set_file_hashes(library_dir / "img0.jpg", (1000, 1, "digest", None))
+    db.close()
+
+
+def test_interrupted_migration_keeps_zodb(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    make_zodb_library(tmp_path, 5)
+    migrate_from = SqliteStorage.migrate_from
+
+    def interrupted(storage, zodb_storage):
+        storage.put(next(iter(zodb_storage.all_images())))
+        storage.commit()
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(SqliteStorage, "migrate_from", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        ImageDatabase(tmp_path, backend="sqlite")
+    assert ImageDatabase.find_backend(tmp_path) == "zodb"
+
+    monkeypatch.setattr(SqliteStorage, "migrate_from", migrate_from)
+    db = ImageDatabase(tmp_path, backend="sqlite")
+    try:
+        assert ImageDatabase.find_backend(tmp_path) == "sqlite"
+        assert db.count_by_path() == 5
+        assert db.count_by_hash() == 5
+        assert db.get_exif(tmp_path / "img3.jpg") == {"EXIF:Make": "test"}
+        assert db.get_file_hashes(tmp_path / "img0.jpg") == (1000, 1, "digest", None)
+    finally:
+        db.close()
+    assert not list(tmp_path.glob(f".imagesort/{SqliteStorage.file_name}.tmp*"))
@@ -0,0 +1,26 @@
+from pathlib import Path
+
+from conftest import make_jpegs, requires_exiftool
+from ImageLoader import ImageLoader
+from ImageSorter import ImageSorter
+
+
+@requires_exiftool
+def test_sort_with_workers_loads_exif(tmp_path: Path):
+    sorted_dir = tmp_path / "sorted"
+    sorted_dir.mkdir()
+    make_jpegs(tmp_path / "incoming", 40)
+    ImageLoader.exif_batch_size = 5
+    image_sorter = ImageSorter(sorted_dir, workers=4, load_cache_bytes=0)
+    try:
+        # the main process runs its own ExifTool before the workers start
+        ImageLoader.instance().load_exif(sorted(sorted_dir.parent.glob("incoming/*.jpg"))[0])
+        image_sorter.sort_dir(tmp_path / "incoming")
+        images = list(image_sorter.db.all_images())
+        assert len(images) == 40
+        for image in images:
+            assert image.ts.year == 2019
+            assert image_sorter.db.get_exif(image.path)["EXIF:DateTimeOriginal"].startswith("2019:")
+    finally:
+        image_sorter.close()
+        ImageLoader.exif_batch_size = 50
@@ -0,0 +1,55 @@
+import argparse
+import os
+import time
+from collections import Counter
+from pathlib import Path
+
+args_parser = argparse.ArgumentParser(description='Compare image hashes computed from a reduced resolution decode (--fast-hash) with full decode hashes')
+args_parser.add_argument('source', type=str, nargs='+', help='Directory(s) with images to compare')
+args_parser.add_argument('--limit', type=int, default=0, help='Stop after this many images (default: no limit)')
+
+if __name__ == "__main__":
+    args = args_parser.parse_args()
+
+    import imagehash
+    from ImageLoader import ImageLoader
+    from ImageSorter import SIMILAR_IMAGE_HASH_DIST
+
+    distances = Counter()
+    full_time = fast_time = 0.0
+    count = 0
+    for source_path_str in args.source:
+        for dir_path, dir_names, file_names in os.walk(source_path_str):
+            dir_names[:] = sorted(name for name in dir_names if not name.startswith("."))
+            for file_name in sorted(file_names):
+                if not ImageLoader.image_re.match(file_name) or (args.limit and count >= args.limit):
+                    continue
+                filename = Path(os.path.join(dir_path, file_name)).as_posix()
+                try:
+                    start = time.monotonic()
+                    image, size = ImageLoader.open_image(filename)
+                    full_hash = imagehash.dhash(image, 10)
+                    full_time += time.monotonic() - start
+                    start = time.monotonic()
+                    image, size = ImageLoader.open_image(filename, reduced=True)
+                    fast_hash = imagehash.dhash(image, 10)
+                    fast_time += time.monotonic() - start
+                except (OSError, ValueError) as e:
+                    print(f"Failed to hash {filename}: {e}")
+                    continue
+                dist = full_hash - fast_hash
+                distances[dist] += 1
+                count += 1
+                if dist > SIMILAR_IMAGE_HASH_DIST:
+                    print(f"{filename}: distance {dist} ({full_hash} != {fast_hash})")
+
+    if not count:
+        print("No images found")
+        exit(1)
+    print(f"Images: {count}")
+    print(f"Identical hashes: {distances[0]} ({100.0 * distances[0] / count:.2f}%)")
+    print(f"Within SIMILAR_IMAGE_HASH_DIST ({SIMILAR_IMAGE_HASH_DIST}): {sum(n for d, n in distances.items() if d <= SIMILAR_IMAGE_HASH_DIST)}")
+    for dist in sorted(distances):
+        print(f"  distance {dist}: {distances[dist]}")
+    print(f"Full decode: {full_time:.2f}s ({count / full_time if full_time else 0:.1f} images/s)")
+    print(f"Reduced decode: {fast_time:.2f}s ({count / fast_time if fast_time else 0:.1f} images/s)")